@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import socket
+import argparse
+import platform
+import selectors
+import signal
+import tempfile
+import threading
+import subprocess
+
+from urtf_client_pipelining import file_digest
+
+MAX_DATAGRAM = 65535
+SELECT_TIMEOUT = 0.1  # seconds, how often the proxy notices it was asked to stop
+QUEUE_LIMIT = 256 * 1024  # Bytes a rate-capped link buffers before it drops (drop-tail)
+REORDER_DELAY = 0.005  # Extra seconds a reordered datagram is held back
+RUN_TIMEOUT = 300  # seconds before a benchmark run is abandoned
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Implementation name -> (client script, server script)
+IMPLEMENTATIONS = {
+    'stop-and-wait': ('urft_client.py', 'urft_server.py'),
+    'pipelined': ('urtf_client_pipelining.py', 'urtf_server_pipelining.py'),
+}
+
+class Impairment:
+    """What the emulated link does to every datagram, applied to each direction independently."""
+
+    def __init__(self, loss=0.0, duplicate=0.0, reorder=0.0, corrupt=0.0, delay=0.0, jitter=0.0, rate=0.0,
+                 queue=QUEUE_LIMIT, mtu=0):
+        self.loss = loss  # Probability a datagram is dropped
+        self.duplicate = duplicate  # Probability a datagram is delivered twice
+        self.reorder = reorder  # Probability a datagram is held back behind later ones
+        self.corrupt = corrupt  # Probability one byte of a datagram is flipped
+        self.delay = delay  # One-way delay in seconds
+        self.jitter = jitter  # Uniform +/- seconds added to the delay
+        self.rate = rate  # Link rate in bytes per second, 0 for unlimited
+        self.queue = queue
+        self.mtu = mtu  # Largest datagram the link carries, bigger ones vanish like DF packets at a small hop
+
+    def as_dict(self):
+        return dict(vars(self))
+
+# Named link profiles for the benchmark matrix
+PROFILES = {
+    'clean': Impairment(),
+    'lossy': Impairment(loss=0.02),
+    'wan': Impairment(loss=0.005, delay=0.02, jitter=0.002, rate=12.5e6, mtu=1472),
+    'hostile': Impairment(loss=0.05, duplicate=0.02, reorder=0.05, corrupt=0.01, delay=0.005, jitter=0.002,
+                          mtu=1372),
+}
+
+class Proxy:
+    """UDP relay between URFT clients and a server that impairs traffic according to an Impairment."""
+
+    def __init__(self, listen_ip, listen_port: int, server_ip, server_port: int, impairment: Impairment,
+                 seed=None):
+        self.server_address = (server_ip, server_port)
+        self.impairment = impairment
+        self.random = random.Random(seed)
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listen_socket.bind((listen_ip, listen_port))
+        self.listen_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listen_socket, selectors.EVENT_READ)
+        self.upstream = {}  # Client address -> socket towards the server, so every client keeps its own port
+        self.pending = []  # Heap of (deliver at, order, socket, datagram, destination)
+        self.order = 0
+        self.link_free = {'upstream': 0.0, 'downstream': 0.0}  # When each direction finishes serialising
+        self.stats = {direction: {'datagrams': 0, 'bytes': 0, 'unique': set(), 'lost': 0, 'duplicated': 0,
+                                  'reordered': 0, 'corrupted': 0, 'queue_drops': 0, 'too_big': 0}
+                      for direction in ('upstream', 'downstream')}
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                timeout = SELECT_TIMEOUT
+                if self.pending:
+                    timeout = min(timeout, max(0.0, self.pending[0][0] - time.monotonic()))
+                for key, _ in self.selector.select(timeout):
+                    self.drain(key.fileobj, key.data)
+                self.deliver_due()
+        finally:
+            self.selector.close()
+            for sock in [self.listen_socket] + list(self.upstream.values()):
+                sock.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def drain(self, sock, client_address):
+        while True:
+            try:
+                data, address = sock.recvfrom(MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            if sock is self.listen_socket:
+                upstream = self.upstream.get(address)
+                if upstream is None:
+                    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    upstream.setblocking(False)
+                    self.upstream[address] = upstream
+                    self.selector.register(upstream, selectors.EVENT_READ, address)
+                self.forward('upstream', upstream, data, self.server_address)
+            else:
+                self.forward('downstream', self.listen_socket, data, client_address)
+
+    def forward(self, direction: str, sock, data: bytes, destination):
+        impairment = self.impairment
+        stats = self.stats[direction]
+        stats['datagrams'] += 1
+        stats['bytes'] += len(data)
+        stats['unique'].add(hash(data))  # Identical datagrams are retransmissions
+        if impairment.mtu and len(data) > impairment.mtu:
+            stats['too_big'] += 1
+            return
+        if self.random.random() < impairment.loss:
+            stats['lost'] += 1
+            return
+        copies = 1
+        if self.random.random() < impairment.duplicate:
+            stats['duplicated'] += 1
+            copies = 2
+        for _ in range(copies):
+            datagram = data
+            if self.random.random() < impairment.corrupt:
+                stats['corrupted'] += 1
+                datagram = bytearray(data)
+                datagram[self.random.randrange(len(datagram))] ^= 0xFF
+                datagram = bytes(datagram)
+            now = time.monotonic()
+            deliver_at = now
+            if impairment.rate:
+                # Serialise behind what is already on the link, dropping once the queue is full
+                start = max(now, self.link_free[direction])
+                if (start - now) * impairment.rate > impairment.queue:
+                    stats['queue_drops'] += 1
+                    continue
+                self.link_free[direction] = start + len(datagram) / impairment.rate
+                deliver_at = self.link_free[direction]
+            deliver_at += max(0.0, impairment.delay + self.random.uniform(-impairment.jitter, impairment.jitter))
+            if self.random.random() < impairment.reorder:
+                stats['reordered'] += 1
+                deliver_at += REORDER_DELAY
+            heapq.heappush(self.pending, (deliver_at, self.order, sock, datagram, destination))
+            self.order += 1
+
+    def deliver_due(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            _, _, sock, datagram, destination = heapq.heappop(self.pending)
+            try:
+                sock.sendto(datagram, destination)
+            except OSError:
+                pass  # The far end went away, the link just drops it
+
+    def summary(self):
+        summary = {}
+        for direction, stats in self.stats.items():
+            summary[direction] = dict(stats, unique=len(stats['unique']))
+        return summary
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_with_usage(process, timeout: float):
+    # Reap the child ourselves so its own CPU time comes back with it, killing it if it overruns
+    deadline = time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            return process.returncode, usage.ru_utime + usage.ru_stime
+        if time.monotonic() > deadline:
+            process.kill()
+        time.sleep(0.01)
+
+def run_once(implementation: str, size: int, profile: str, seed: int, timeout: float):
+    client_script, server_script = IMPLEMENTATIONS[implementation]
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_dir = os.path.join(work_dir, 'source')
+        sink_dir = os.path.join(work_dir, 'sink')
+        os.mkdir(source_dir)
+        os.mkdir(sink_dir)
+        file_path = os.path.join(source_dir, 'bench.bin')
+        with open(file_path, 'wb') as file:
+            file.write(random.Random(seed).getrandbits(size * 8).to_bytes(size, 'big') if size else b'')
+
+        server_port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, server_script), '127.0.0.1', str(server_port)],
+                                  cwd=sink_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        proxy = Proxy('127.0.0.1', 0, '127.0.0.1', server_port, PROFILES[profile], seed)
+        proxy_port = proxy.listen_socket.getsockname()[1]
+        proxy_thread = threading.Thread(target=proxy.run, daemon=True)
+        proxy_thread.start()
+        time.sleep(0.2)  # Let the server bind before the first packet
+
+        start = time.perf_counter()
+        stats_path = os.path.join(work_dir, 'client-stats.json')
+        client = subprocess.Popen([sys.executable, os.path.join(HERE, client_script), file_path, '127.0.0.1',
+                                   str(proxy_port), '--stats', stats_path],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client_code, client_cpu = wait_with_usage(client, timeout)
+        elapsed = time.perf_counter() - start
+
+        time.sleep(0.2)  # Let the final writes land before the server is stopped
+        server.send_signal(signal.SIGINT)
+        _, server_cpu = wait_with_usage(server, 5)
+        proxy.stop()
+        proxy_thread.join()
+
+        client_stats = None
+        if os.path.exists(stats_path):
+            with open(stats_path) as file:
+                client_stats = json.loads(file.readline())
+        received = os.path.join(sink_dir, 'bench.bin')
+        ok = client_code == 0 and os.path.exists(received) and file_digest(received) == file_digest(file_path)
+        link = proxy.summary()
+        upstream = link['upstream']
+        return {
+            'implementation': implementation,
+            'size': size,
+            'profile': profile,
+            'seed': seed,
+            'ok': ok,
+            'elapsed': elapsed,
+            'goodput_bps': size * 8 / elapsed if ok and elapsed else 0.0,
+            'retransmission_ratio': (upstream['datagrams'] - upstream['unique']) / upstream['unique']
+            if upstream['unique'] else 0.0,
+            'client_cpu': client_cpu,
+            'server_cpu': server_cpu,
+            'link': link,
+            'client_stats': client_stats,  # The client's own counters and samples, see its --stats
+        }
+
+def benchmark(args):
+    runs = []
+    for implementation in args.implementations:
+        for profile in args.profiles:
+            for size in args.sizes:
+                for repeat in range(args.repeat):
+                    result = run_once(implementation, size, profile, args.seed + repeat, args.timeout)
+                    runs.append(result)
+                    print(f"{implementation:>13} {profile:>8} {size:>10} B: "
+                          f"{'ok' if result['ok'] else 'FAILED':>6} {result['elapsed']:7.2f} s "
+                          f"{result['goodput_bps'] / 1e6:8.2f} Mbit/s "
+                          f"retx {result['retransmission_ratio']:.3f}", file=sys.stderr)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'profiles': {name: PROFILES[name].as_dict() for name in args.profiles},
+        'runs': runs,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    return all(run['ok'] for run in runs)
+
+def proxy_main(args):
+    impairment = Impairment(args.loss, args.duplicate, args.reorder, args.corrupt, args.delay, args.jitter,
+                            args.rate, args.queue, args.mtu)
+    proxy = Proxy(args.listen_ip, args.listen_port, args.server_ip, args.server_port, impairment, args.seed)
+    print(f"Relaying {args.listen_ip}:{args.listen_port} -> {args.server_ip}:{args.server_port}")
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        print(json.dumps(proxy.summary(), indent=2))
+
+def csv_list(convert):
+    return lambda text: [convert(item) for item in text.split(',') if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate an impaired link for URFT and benchmark the implementations over it.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    proxy_parser = commands.add_parser('proxy', help="relay datagrams to a server through an impaired link")
+    proxy_parser.add_argument('listen_ip')
+    proxy_parser.add_argument('listen_port', type=int)
+    proxy_parser.add_argument('server_ip')
+    proxy_parser.add_argument('server_port', type=int)
+    proxy_parser.add_argument('--loss', type=float, default=0.0, help="drop probability")
+    proxy_parser.add_argument('--duplicate', type=float, default=0.0, help="duplication probability")
+    proxy_parser.add_argument('--reorder', type=float, default=0.0, help="reordering probability")
+    proxy_parser.add_argument('--corrupt', type=float, default=0.0, help="single-byte corruption probability")
+    proxy_parser.add_argument('--delay', type=float, default=0.0, help="one-way delay in seconds")
+    proxy_parser.add_argument('--jitter', type=float, default=0.0, help="uniform delay variation in seconds")
+    proxy_parser.add_argument('--rate', type=float, default=0.0, help="link rate in bytes per second (0: unlimited)")
+    proxy_parser.add_argument('--queue', type=int, default=QUEUE_LIMIT,
+                              help=f"bytes buffered by a rate-capped link (default: {QUEUE_LIMIT})")
+    proxy_parser.add_argument('--mtu', type=int, default=0,
+                              help="drop datagrams larger than this many bytes (default: 0, no limit)")
+    proxy_parser.add_argument('--seed', type=int, help="random seed for reproducible impairments")
+
+    bench_parser = commands.add_parser('bench', help="run the implementations across sizes and link profiles")
+    bench_parser.add_argument('--implementations', type=csv_list(str), default=sorted(IMPLEMENTATIONS),
+                              help=f"comma-separated, from {', '.join(sorted(IMPLEMENTATIONS))}")
+    bench_parser.add_argument('--profiles', type=csv_list(str), default=['clean', 'lossy', 'wan'],
+                              help=f"comma-separated, from {', '.join(PROFILES)}")
+    bench_parser.add_argument('--sizes', type=csv_list(int), default=[100000, 1000000],
+                              help="comma-separated file sizes in bytes")
+    bench_parser.add_argument('--repeat', type=int, default=1, help="runs per combination")
+    bench_parser.add_argument('--seed', type=int, default=1, help="seed for file contents and impairments")
+    bench_parser.add_argument('--timeout', type=float, default=RUN_TIMEOUT,
+                              help=f"seconds before a run is abandoned (default: {RUN_TIMEOUT})")
+    bench_parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    if args.command == 'proxy':
+        proxy_main(args)
+        return
+    for name in args.implementations:
+        if name not in IMPLEMENTATIONS:
+            parser.error(f"unknown implementation {name}")
+    for name in args.profiles:
+        if name not in PROFILES:
+            parser.error(f"unknown profile {name}")
+    sys.exit(0 if benchmark(args) else 1)
+
+if __name__ == '__main__':
+    main()
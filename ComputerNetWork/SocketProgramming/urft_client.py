@@ -2,95 +2,229 @@ import os
 import sys
 import socket
 import hashlib
+import random
+import time
+import struct
+import argparse
 
-TOTAL_PACKET_SIZE = 1024
+from urtf_client_pipelining import CHECKSUM_IDS, CHECKSUMS, Stats, probe_path_mtu
+
+TOTAL_PACKET_SIZE = 1024  # Proposed in the handshake when path MTU probes go unanswered
+MIN_PACKET_SIZE = 512
+MAX_PACKET_SIZE = 9000  # Jumbo frame payload, also the receive buffer for replies
+SESSION_ID_SIZE = 4
 SEQUENCE_NUM_SIZE = 4
-CHECKSUM_SIZE = 32
-HEADER_SIZE = SEQUENCE_NUM_SIZE + CHECKSUM_SIZE
-PAYLOAD_SIZE = TOTAL_PACKET_SIZE - HEADER_SIZE
+CHECKSUM_SIZE = 32  # SHA-256, protects the session start packet
+EOF_SEQ_NUM = 0xFFFFFFFF  # Marks the EOF packet, whose payload is the final sequence number and the digest
+PROTOCOL_VERSION = 2  # Sent in the handshake, the server refuses any other
+HANDSHAKE_SEQ_NUM = 0xFFFFFFFC  # Sequence number of the handshake and its reply, never a data segment or an ACK
+START_STRUCT = struct.Struct('!BBQHI')  # Version, checksum proposal, file size, packet size, window, then the file name
+# Handshake sequence number, version, then the checksum, packet size and window the server took
+HANDSHAKE_REPLY = struct.Struct('!IBBHI')
 BYTE_ORDER = 'big'
 TIMEOUT = 1  # seconds
 
 class Client:
-    def __init__(self, server_ip, server_port: int):
+    def __init__(self, server_ip, server_port: int, checksum: str = 'crc32', debug: bool = False,
+                 stats_file: str = None, packet_size: int = 0):
         self.server_ip = server_ip
         self.server_port = server_port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.client_socket.settimeout(TIMEOUT)
+        # Prefixes every packet so the server can tell concurrent transfers from one address apart
+        self.session_id = random.getrandbits(SESSION_ID_SIZE * 8).to_bytes(SESSION_ID_SIZE, BYTE_ORDER)
+        self.proposed_checksum = CHECKSUM_IDS[checksum]
+        self.proposed_packet_size = packet_size  # 0 probes the path for the largest one
+        # The first segment goes out before the handshake reply (0-RTT), under the proposal
+        self.use_settings(self.proposed_checksum, packet_size or TOTAL_PACKET_SIZE)
+        self.handshake = None  # Handshake packet until the server's reply, or an ACK of data, confirms it
+        self.stats = Stats(debug)
+        self.stats_file = stats_file  # Where the JSON record of the transfer is appended, if anywhere
+        self.digest = hashlib.sha256()  # Fed as segments are first read, so the file is never re-read
+
+    def use_settings(self, checksum_id: int, packet_size: int):
+        self.checksum_id = checksum_id
+        _, self.checksum_size, self.checksum = CHECKSUMS[checksum_id]
+        self.packet_size = packet_size
+        self.payload_size = packet_size - SESSION_ID_SIZE - SEQUENCE_NUM_SIZE - self.checksum_size
 
-    def split_data(self, data: bytes):
-        return [data[i:i + PAYLOAD_SIZE] for i in range(0, len(data), PAYLOAD_SIZE)]
+    def negotiate(self, file_name: bytes, file_size: int, wait: bool = True):
+        # Handshake: version, checksum proposal, file size, packet size and window ahead of the file name, under
+        # SHA-256. The server answers with the settings it took. Without wait the first segment follows straight
+        # away and the reply is picked up while waiting for its ACK.
+        if not self.proposed_packet_size:
+            self.proposed_packet_size, _ = probe_path_mtu(self.client_socket, (self.server_ip, self.server_port),
+                                                          self.session_id, TOTAL_PACKET_SIZE)
+            self.use_settings(self.proposed_checksum, self.proposed_packet_size)
+        payload = START_STRUCT.pack(PROTOCOL_VERSION, self.proposed_checksum, file_size, self.proposed_packet_size,
+                                    1) + file_name
+        self.handshake = (self.session_id + HANDSHAKE_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                          + hashlib.sha256(payload).digest() + payload)
+        self.client_socket.sendto(self.handshake, (self.server_ip, self.server_port))
+        while wait and self.handshake is not None:
+            try:
+                reply, _ = self.client_socket.recvfrom(MAX_PACKET_SIZE)
+                self.take_handshake_reply(reply)
+            except socket.timeout:
+                print("Timeout for handshake, resending...")
+                self.client_socket.sendto(self.handshake, (self.server_ip, self.server_port))
 
-    def send_data(self, data: bytes):
-        segments = self.split_data(data)
+    def take_handshake_reply(self, reply: bytes):
+        # None if reply is not the handshake reply, otherwise whether the server kept the proposed settings
+        body = reply[CHECKSUM_SIZE:]
+        if len(body) != HANDSHAKE_REPLY.size or hashlib.sha256(body).digest() != reply[:CHECKSUM_SIZE]:
+            return None
+        sequence_number, version, checksum_id, packet_size, _ = HANDSHAKE_REPLY.unpack(body)
+        if sequence_number != HANDSHAKE_SEQ_NUM or version != PROTOCOL_VERSION or checksum_id not in CHECKSUMS:
+            return None
+        self.handshake = None
+        kept = (checksum_id, packet_size) == (self.checksum_id, self.packet_size)
+        if not kept:
+            self.use_settings(checksum_id, packet_size)
+        print(f"Using {CHECKSUMS[checksum_id][0]} per-packet checksum, {packet_size}-byte packets.")
+        return kept
+
+    def open_reply(self, reply: bytes):
+        # Every reply after the handshake leads with the session checksum of the rest, a damaged one is dropped
+        body = reply[self.checksum_size:]
+        if len(reply) < self.checksum_size or self.checksum(body) != reply[:self.checksum_size]:
+            self.stats.counters['reply_checksum_failures'] += 1
+            return None
+        return body
+
+    def receive_ack(self):
+        # Next data ACK, None if the handshake reply came back with other settings than the ones proposed
+        while True:
+            reply, _ = self.client_socket.recvfrom(MAX_PACKET_SIZE)
+            if self.handshake is not None:
+                kept = self.take_handshake_reply(reply)
+                if kept is not None:
+                    if not kept:
+                        return None
+                    continue
+            ack = self.open_reply(reply)
+            if ack is not None and len(ack) == SEQUENCE_NUM_SIZE:
+                return ack
+
+    def read_segments(self, file):
+        # Stream the file through one reusable buffer instead of reading it whole
+        buffer = bytearray(self.payload_size)
+        view = memoryview(buffer)
+        while True:
+            n = file.readinto(buffer)
+            if not n:
+                break
+            self.digest.update(view[:n])
+            yield view[:n]
+
+    def send_data(self, segments):
+        # False if the segments were cut for settings the server did not take
         global sequence_number
         sequence_number = 0
         
         for segment in segments:
+            attempts = 0
             while True:
-                checksum = hashlib.sha256(segment).digest()
-                header = sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + checksum
+                checksum = self.checksum(segment)
+                header = self.session_id + sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + checksum
                 packet = header + segment
                 self.client_socket.sendto(packet, (self.server_ip, self.server_port))
+                send_time = time.time()
+                self.stats.counters['packets_sent'] += 1
+                if attempts:
+                    self.stats.counters['retransmissions'] += 1
+                attempts += 1
 
                 try:
-                    ack, _ = self.client_socket.recvfrom(SEQUENCE_NUM_SIZE)
+                    ack = self.receive_ack()
+                    if ack is None:
+                        return False
                     ack_sequence_number = int.from_bytes(ack, BYTE_ORDER)
+                    self.stats.counters['acks_received'] += 1
 
                     if ack_sequence_number == sequence_number:
-                        print(f"Received ACK for segment {sequence_number}")
+                        self.handshake = None  # The segment was taken under the proposed settings
+                        if attempts == 1:
+                            self.stats.add_rtt(time.time() - send_time)  # Karn: retransmitted segments are ambiguous
+                        self.stats.counters['bytes_acked'] += len(segment)
+                        self.stats.tick(self.stats.counters['bytes_acked'])
+                        if self.stats.debug:
+                            print(f"Received ACK for segment {sequence_number}")
                         sequence_number += 1
-                        print(f"Sending segment {sequence_number}")
                         break
                     else:
-                        print(f"Incorrect ACK {ack_sequence_number} for segment {sequence_number}, resending...")
+                        self.stats.counters['wrong_acks'] += 1
+                        if self.stats.debug:
+                            print(f"Incorrect ACK {ack_sequence_number} for segment {sequence_number}, resending...")
                 except socket.timeout:
-                    print(f"Timeout for segment {sequence_number}, resending...")
-        
+                    if self.handshake is not None:
+                        self.client_socket.sendto(self.handshake, (self.server_ip, self.server_port))
+                    self.stats.counters['timeouts'] += 1
+                    if self.stats.debug:
+                        print(f"Timeout for segment {sequence_number}, resending...")
+        return True
 
     def send_eof(self, sequence_number):
-        eof_packet = sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + hashlib.sha256(b'').digest() + b''
+        # The payload tells the server where the data ended and what it should hash to
+        payload = sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + self.digest.digest()
+        eof_packet = self.session_id + EOF_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + self.checksum(payload) + payload
         while True:
             self.client_socket.sendto(eof_packet, (self.server_ip, self.server_port))
             try:
-                ack, _ = self.client_socket.recvfrom(SEQUENCE_NUM_SIZE)
-                ack_sequence_number = int.from_bytes(ack, BYTE_ORDER)
-                if ack_sequence_number == sequence_number:
+                ack = self.open_reply(self.client_socket.recvfrom(MAX_PACKET_SIZE)[0])
+                if ack is not None and len(ack) == SEQUENCE_NUM_SIZE + 1 and int.from_bytes(ack[:SEQUENCE_NUM_SIZE], BYTE_ORDER) == EOF_SEQ_NUM:
                     print("EOF sent and acknowledged.")
-                    break
-                else:
-                    print("Incorrect ACK for EOF, resending...")
+                    return ack[SEQUENCE_NUM_SIZE] == 1
+                if self.stats.debug:
+                    print("Stale ACK while waiting for the EOF reply, ignoring...")
             except socket.timeout:
                 print("Timeout for EOF, resending...")
 
     def send(self, file_path: str):
         file_name = os.path.basename(file_path).encode("utf-8")
         print(f"Sending file name: {file_name.decode('utf-8')}")
-        self.send_data(file_name)
-
         with open(file_path, 'rb') as file:
-            content = file.read()
-            print(f"Sending file content ({len(content)} bytes).")
-            self.send_data(content)
+            size = os.fstat(file.fileno()).st_size
+            # An empty file has no segment to confirm the handshake with, it waits for the reply instead
+            self.negotiate(file_name, size, wait=size == 0)
+            print(f"Sending file content ({size} bytes).")
+            while not self.send_data(self.read_segments(file)):
+                # The server took other settings than proposed, start over under them
+                file.seek(0)
+                self.digest = hashlib.sha256()
         
         print("Sending EOF.")
-        self.send_eof(sequence_number)
+        verified = self.send_eof(sequence_number)
 
-        print("File sent successfully.")
-        print(hashlib.sha256(open(file_path, 'rb').read()).hexdigest())
+        if verified:
+            print("File sent and verified successfully.")
+        else:
+            print("Server copy does not match the file.")
+        print(self.digest.hexdigest())
+        if self.stats_file:
+            self.stats.dump(self.stats_file, file=file_name.decode('utf-8'), verified=verified)
         self.client_socket.close()
+        return verified
 
 def main():
-    if len(sys.argv) < 4:
-        print(f"Usage: {sys.argv[0]} <file_path> <server_ip> <server_port>")
-        sys.exit(1)
-
-    file_path = sys.argv[1]
-    server_ip = sys.argv[2]
-    server_port = int(sys.argv[3])
+    parser = argparse.ArgumentParser(description="Send a file to a URFT server, one segment at a time.")
+    parser.add_argument('file_path')
+    parser.add_argument('server_ip')
+    parser.add_argument('server_port', type=int)
+    parser.add_argument('--checksum', choices=sorted(CHECKSUM_IDS), default='crc32',
+                        help="per-packet checksum to propose to the server (default: crc32)")
+    parser.add_argument('--packet-size', type=int, default=0, metavar='BYTES',
+                        help="datagram size to propose to the server, headers included (default: 0, the largest "
+                             "that passes a path MTU probe)")
+    parser.add_argument('--debug', action='store_true', help="log every packet and ACK")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="append a JSON record of the transfer to FILE ('-' for stdout)")
+    args = parser.parse_args()
+    if args.packet_size and not MIN_PACKET_SIZE <= args.packet_size <= MAX_PACKET_SIZE:
+        parser.error(f"--packet-size must be between {MIN_PACKET_SIZE} and {MAX_PACKET_SIZE}")
 
-    client = Client(server_ip, server_port)
-    client.send(file_path)
+    client = Client(args.server_ip, args.server_port, args.checksum, args.debug, args.stats, args.packet_size)
+    sys.exit(0 if client.send(args.file_path) else 1)
 
 if __name__ == '__main__':
     main()
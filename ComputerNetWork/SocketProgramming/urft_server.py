@@ -1,99 +1,305 @@
-import os
-import sys
 import socket
 import hashlib
+import time
+import argparse
+import json
+import queue
+import threading
+import struct
 
-TOTAL_PACKET_SIZE = 1024
+from urtf_client_pipelining import CHECKSUM_SHA256, CHECKSUMS, Stats
+from urtf_server_pipelining import local_path
+
+MIN_PACKET_SIZE = 512
+MAX_PACKET_SIZE = 9000  # Largest packet size granted, jumbo frame payload
+SESSION_ID_SIZE = 4
 SEQUENCE_NUM_SIZE = 4
-CHECKSUM_SIZE = 32
-HEADER_SIZE = SEQUENCE_NUM_SIZE + CHECKSUM_SIZE
-PAYLOAD_SIZE = TOTAL_PACKET_SIZE - HEADER_SIZE
+CHECKSUM_SIZE = 32  # SHA-256, protects the session start packet
+DIGEST_SIZE = 32  # SHA-256 of the whole file, carried by the EOF packet
+EOF_SEQ_NUM = 0xFFFFFFFF  # Marks the EOF packet, whose payload is the final sequence number and the digest
+PROTOCOL_VERSION = 2  # Handshakes carrying any other version are refused
+HANDSHAKE_SEQ_NUM = 0xFFFFFFFC  # Sequence number of the handshake and its reply, never a data segment or an ACK
+PROBE_SEQ_NUM = 0xFFFFFFFB  # Sequence number of a path MTU probe, echoed with its size outside any session
+START_STRUCT = struct.Struct('!BBQHI')  # Version, checksum proposal, file size, packet size, window, then the file name
+# Handshake sequence number, version, then the checksum, packet size and window taken
+HANDSHAKE_REPLY = struct.Struct('!IBBHI')
+HEADER_SIZE = SESSION_ID_SIZE + SEQUENCE_NUM_SIZE + CHECKSUM_SIZE
 BYTE_ORDER = 'big'
 TIMEOUT = 1  # seconds
+SESSION_TIMEOUT = 30  # seconds of silence before a session is dropped
+MAX_SESSIONS = 64  # Concurrent transfers accepted at once
+STATS_REQUEST = b'STAT'  # Datagram asking for the server's statistics, answered with JSON if enabled
+RING_BYTES = 2 * 1024 * 1024  # Receive ring between the socket thread and the protocol thread, in bytes
+WRITE_BATCH = 256 * 1024  # Bytes of a file gathered into one write
+
+class Session:
+    """Receive state of one transfer, keyed by client address and session id."""
+
+    def __init__(self, address, session_id: int, file_name: str, file_size: int, checksum_id: int, packet_size: int,
+                 start_packet: bytes):
+        self.address = address
+        self.session_id = session_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.checksum_id = checksum_id
+        _, checksum_size, self.checksum = CHECKSUMS[checksum_id]
+        self.header_size = SESSION_ID_SIZE + SEQUENCE_NUM_SIZE + checksum_size
+        self.packet_size = packet_size
+        self.payload_size = packet_size - self.header_size
+        self.start_packet = start_packet  # Duplicates of it are re-ACKed, not taken as data
+        self.file = open(file_name, 'wb', buffering=WRITE_BATCH)  # Segments arrive in order, so they batch up
+        self.expected_sequence_number = 0  # Start expecting the first data packet
+        self.eof_sequence_number = None
+        self.digest = hashlib.sha256()  # Fed with each in-order write, compared with the sender's at EOF
+        self.verified = False
+        self.stats = Stats(quiet=True)  # This transfer alone, dumped when it ends
+        self.start_time = self.last_active = time.time()
+
+    def seal(self, body: bytes):
+        # Replies lead with the session checksum of the rest, so the sender can drop damaged ones
+        return self.checksum(body) + body
 
 class Server:
-    def __init__(self, server_ip, server_port: int):
+    def __init__(self, server_ip, server_port: int, max_sessions: int = MAX_SESSIONS, debug: bool = False,
+                 stats_file: str = None, stats_endpoint: bool = False):
         self.server_ip = server_ip
         self.server_port = server_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_socket.bind((self.server_ip, self.server_port))
+        self.server_socket.settimeout(TIMEOUT)  # The receive thread wakes up to notice the server closing
+        # The receive thread reads datagrams into free slots of this ring and queues them, the protocol thread
+        # handles them through views of the slot and hands it back, so a slow disk backs datagrams up here
+        # rather than in the socket buffer
+        self.ring = [memoryview(bytearray(MAX_PACKET_SIZE)) for _ in range(RING_BYTES // MAX_PACKET_SIZE)]
+        self.free_slots = queue.SimpleQueue()
+        for index in range(len(self.ring)):
+            self.free_slots.put(index)
+        self.ready = queue.SimpleQueue()  # (slot, bytes read, client address)
+        self.stopping = threading.Event()
+        self.max_sessions = max_sessions
+        self.sessions = {}  # (client address, session id) -> Session
+        self.stats = Stats(debug)
+        self.stats_file = stats_file  # Where a JSON record of every finished transfer is appended, if anywhere
+        self.stats_endpoint = stats_endpoint  # Whether STAT datagrams are answered
 
     def receive(self):
-        while True:
+        receiver = threading.Thread(target=self.receive_datagrams, daemon=True)
+        receiver.start()
+        try:
+            while True:
+                try:
+                    self.handle_slot(*self.ready.get(timeout=TIMEOUT))
+                    while True:
+                        self.handle_slot(*self.ready.get_nowait())
+                except queue.Empty:
+                    pass
+                if any(session.eof_sequence_number is None for session in self.sessions.values()):
+                    self.stats.tick(self.stats.counters['bytes_received'])
+                for session in self.sessions.values():
+                    if session.eof_sequence_number is None:
+                        session.stats.tick(session.stats.counters['bytes_received'])
+                self.expire_sessions()
+        except KeyboardInterrupt:
+            print("Server closed.")
+        finally:
+            self.stopping.set()
+            receiver.join()
+            for session in self.sessions.values():
+                session.file.close()
+            self.server_socket.close()
+
+    def receive_datagrams(self):
+        # Socket stage, on its own thread: one socket serves all sessions, read it into the ring as fast as the
+        # kernel hands datagrams over
+        while not self.stopping.is_set():
+            if self.free_slots.empty():
+                self.stats.counters['ring_full'] += 1
+            try:
+                index = self.free_slots.get(timeout=TIMEOUT)
+            except queue.Empty:
+                continue
             try:
-                # Receive file name
-                data, client_address = self.server_socket.recvfrom(TOTAL_PACKET_SIZE)
-                header = data[:HEADER_SIZE]
-                file_name_payload = data[HEADER_SIZE:]
-                file_name = file_name_payload.decode("utf-8")
-
-                # Send ACK for file name
-                self.server_socket.sendto((0).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), client_address)
-                print(f"Receiving file name: {file_name}")
-                
-                #detect EOF of file name
-                if len(file_name_payload) == 0:
+                nbytes, client_address = self.server_socket.recvfrom_into(self.ring[index])
+            except socket.timeout:
+                self.free_slots.put(index)
+                continue
+            self.ready.put((index, nbytes, client_address))
+
+    def handle_slot(self, index: int, nbytes: int, client_address):
+        try:
+            self.handle_packet(self.ring[index][:nbytes], client_address)
+        except Exception as e:
+            print(f"Error: {e}")
+        self.free_slots.put(index)
+
+    def count(self, session: Session, name: str, n: int = 1):
+        # Server-wide for the STAT endpoint, and the session's own for its record
+        self.stats.counters[name] += n
+        session.stats.counters[name] += n
+
+    def expire_sessions(self):
+        now = time.time()
+        for key, session in list(self.sessions.items()):
+            if now - session.last_active > SESSION_TIMEOUT:
+                if session.eof_sequence_number is None:
+                    print(f"Session {session.session_id:08x} from {session.address} timed out, dropping {session.file_name}")
+                session.file.close()
+                del self.sessions[key]
+
+    def handle_packet(self, data: memoryview, client_address):
+        if data == STATS_REQUEST and self.stats_endpoint:
+            self.send_stats(client_address)
+            return
+        if len(data) < SESSION_ID_SIZE + SEQUENCE_NUM_SIZE:
+            self.stats.counters['incomplete'] += 1
+            if self.stats.debug:
+                print("Received an incomplete packet, ignoring...")
+            return
+        session_id = int.from_bytes(data[:SESSION_ID_SIZE], BYTE_ORDER)
+        sequence_number = int.from_bytes(data[SESSION_ID_SIZE:SESSION_ID_SIZE + SEQUENCE_NUM_SIZE], BYTE_ORDER)
+        if sequence_number == PROBE_SEQ_NUM:
+            # Path MTU probe, its size tells the client this much gets through
+            self.stats.counters['probes'] += 1
+            self.server_socket.sendto(PROBE_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                                      + len(data).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), client_address)
+            return
+        session = self.sessions.get((client_address, session_id))
+        if session is None or sequence_number == HANDSHAKE_SEQ_NUM:
+            self.start_session(data, client_address, session_id, sequence_number, session)
+            return
+        session.last_active = time.time()
+        self.count(session, 'packets_received')
+
+        if len(data) < session.header_size:
+            self.count(session, 'incomplete')
+            if self.stats.debug:
+                print("Received an incomplete packet, ignoring...")
+            return
+
+        # Extract header
+        header = data[:session.header_size]
+        received_checksum = header[SESSION_ID_SIZE + SEQUENCE_NUM_SIZE:]
+
+        payload = data[session.header_size:]
+        calculated_checksum = session.checksum(payload)
+        if len(payload) > session.payload_size:
+            # Sent ahead of the handshake reply under a larger packet size than the one granted
+            self.count(session, 'oversized')
+            return
+
+        # Valid packet check
+        if received_checksum == calculated_checksum:
+            if sequence_number == EOF_SEQ_NUM and len(payload) == SEQUENCE_NUM_SIZE + DIGEST_SIZE:
+                # EOF, re-ACKed with the verification result for as long as the finished session is remembered
+                if session.eof_sequence_number is None:
                     print("EOF received.")
-                    continue
+                    session.eof_sequence_number = int.from_bytes(payload[:SEQUENCE_NUM_SIZE], BYTE_ORDER)
+                    session.verified = (session.eof_sequence_number == session.expected_sequence_number
+                                        and session.digest.digest() == payload[SEQUENCE_NUM_SIZE:])
+                    session.file.close()
+                    if session.verified:
+                        print(f"File {session.file_name} received and verified successfully.")
+                    else:
+                        print(f"File {session.file_name} does NOT match the sender's digest.")
+                    print(session.digest.hexdigest())
+                    elapsed = time.time() - session.start_time
+                    print(f"Took {elapsed:.2f} seconds")
+                    if self.stats_file:
+                        session.stats.dump(self.stats_file, file=session.file_name,
+                                           session=f"{session.session_id:08x}", transfer_elapsed=round(elapsed, 3),
+                                           verified=session.verified)
+                reply = EOF_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + bytes([session.verified])
+                self.server_socket.sendto(session.seal(reply), client_address)
+                return
+            if session.eof_sequence_number is not None:
+                return  # Straggler from a finished transfer
+            if sequence_number == session.expected_sequence_number:
+                session.file.write(payload)
+                session.digest.update(payload)
+                self.count(session, 'bytes_received', len(payload))
+                if self.stats.debug:
+                    print(f"Received segment {sequence_number} ({len(payload)} bytes).")
+                session.expected_sequence_number += 1
+            else:
+                self.count(session, 'duplicates' if sequence_number < session.expected_sequence_number else 'out_of_order')
+                if self.stats.debug:
+                    print(f"Out-of-order packet: expected {session.expected_sequence_number}, got {sequence_number}")
+        else:
+            self.count(session, 'checksum_failures')
+            if self.stats.debug:
+                print(f"Checksum mismatch for segment {sequence_number}, ignoring...")
 
-                with open(file_name, 'wb') as file:
-                    expected_sequence_number = 0  # Start expecting the first data packet
+        # Send ACK
+        ack_header = (session.expected_sequence_number - 1).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER, signed=True)
+        self.server_socket.sendto(session.seal(ack_header), client_address)
 
-                    while True:
-                        data, client_address = self.server_socket.recvfrom(TOTAL_PACKET_SIZE)
-
-                        if len(data) < HEADER_SIZE:
-                            print("Received an incomplete packet, ignoring...")
-                            continue
-
-                        # Extract header
-                        header = data[:HEADER_SIZE]
-                        sequence_number = int.from_bytes(header[:SEQUENCE_NUM_SIZE], BYTE_ORDER)
-                        received_checksum = header[SEQUENCE_NUM_SIZE:]
-
-                        payload = data[HEADER_SIZE:]
-                        calculated_checksum = hashlib.sha256(payload).digest()
-
-                        # Valid packet check
-                        if received_checksum == calculated_checksum:
-                            if sequence_number == expected_sequence_number:
-                                if len(payload) == 0:  # EOF check
-                                    print("EOF received.")
-                                    self.server_socket.sendto(sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), client_address)
-                                    break
-                                file.write(payload)
-                                print(f"Received segment {sequence_number} ({len(payload)} bytes).")
-                                expected_sequence_number += 1
-                            else:
-                                print(f"Out-of-order packet: expected {expected_sequence_number}, got {sequence_number}")
-                        else:
-                            print(f"Checksum mismatch for segment {sequence_number}, ignoring...")
-
-                        # Send ACK
-                        ack_header = (expected_sequence_number - 1).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
-                        self.server_socket.sendto(ack_header, client_address)
-                    
-                
-                print(f"File {file_name} received successfully.")
-                print(hashlib.sha256(open(file_name, 'rb').read()).hexdigest())
+    def start_session(self, data: memoryview, client_address, session_id: int, sequence_number: int, session):
+        # Handshake: version, checksum proposal, file size, packet size and window, then the file name
+        header = data[:HEADER_SIZE]
+        payload = data[HEADER_SIZE:]
+        if len(payload) <= START_STRUCT.size or sequence_number != HANDSHAKE_SEQ_NUM \
+                or header[SESSION_ID_SIZE + SEQUENCE_NUM_SIZE:] != hashlib.sha256(payload).digest():
+            if session is None:
+                # Normal after a lost or overtaken handshake (data follows it without waiting) or an expired session
+                self.stats.counters['unknown_session'] += 1
+                if self.stats.debug:
+                    print(f"Packet for unknown session {session_id:08x} from {client_address}, ignoring...")
+            return
+        if session is not None and data != session.start_packet:
+            return  # Another handshake under an id already in use
 
-            except socket.timeout:
-                pass
-            except KeyboardInterrupt:
-                print("Server closed.")
-                self.server_socket.close()
-                break
+        if session is None:
+            version, checksum_id, file_size, packet_size, _ = START_STRUCT.unpack_from(payload)
+            if version != PROTOCOL_VERSION:
+                print(f"Unsupported protocol version {version} from {client_address}, ignoring...")
+                return
+            active = sum(1 for other in self.sessions.values() if other.eof_sequence_number is None)
+            if active >= self.max_sessions:
+                print(f"Session limit reached, refusing {client_address}")
+                return
+            # Accept the client's checksum proposal if we know it, fall back to SHA-256 otherwise, and its packet
+            # size within what we are prepared to receive
+            if checksum_id not in CHECKSUMS:
+                checksum_id = CHECKSUM_SHA256
+            packet_size = min(max(packet_size, MIN_PACKET_SIZE), MAX_PACKET_SIZE)
+            file_name = local_path(bytes(payload[START_STRUCT.size:]).decode("utf-8"))
+            if file_name is None:
+                print(f"Refusing {client_address}: file name is absolute or outside the working directory")
+                return
+            session = Session(client_address, session_id, file_name, file_size, checksum_id, packet_size, bytes(data))
+            self.sessions[(client_address, session_id)] = session
+            print(f"Receiving file name: {session.file_name} ({file_size} bytes, {CHECKSUMS[checksum_id][0]} "
+                  f"checksum, {packet_size}-byte packets) from {client_address}, session {session_id:08x}")
+        session.last_active = time.time()
+
+        # Reply with the settings taken, one segment at a time, under SHA-256 like the handshake since the client
+        # may not know the checksum yet
+        reply = HANDSHAKE_REPLY.pack(HANDSHAKE_SEQ_NUM, PROTOCOL_VERSION, session.checksum_id, session.packet_size, 1)
+        self.server_socket.sendto(hashlib.sha256(reply).digest() + reply, client_address)
+
+    def send_stats(self, client_address):
+        # Pull endpoint on the transfer port itself
+        snapshot = dict(self.stats.as_dict(),
+                        active_sessions=sum(1 for session in self.sessions.values() if session.eof_sequence_number is None))
+        self.server_socket.sendto(json.dumps(snapshot).encode("utf-8"), client_address)
 
 def main():
-    if len(sys.argv) < 3:
-        print(f"Usage: {sys.argv[0]} <server_ip> <server_port>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Receive files from URFT clients, one segment at a time.")
+    parser.add_argument('server_ip')
+    parser.add_argument('server_port', type=int)
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS,
+                        help=f"concurrent transfers accepted at once (default: {MAX_SESSIONS})")
+    parser.add_argument('--debug', action='store_true', help="log every packet")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="append a JSON record of every finished transfer to FILE ('-' for stdout)")
+    parser.add_argument('--stats-endpoint', action='store_true',
+                        help="answer 'STAT' datagrams on the transfer port with a JSON snapshot of the statistics "
+                             "(off by default: any source gets a reply much larger than the query)")
+    args = parser.parse_args()
 
-    server_ip = sys.argv[1]
-    server_port = int(sys.argv[2])
-    server = Server(server_ip, server_port)
+    server = Server(args.server_ip, args.server_port, args.max_sessions, args.debug, args.stats, args.stats_endpoint)
 
-    print(f"Server is listening on {server_ip}:{server_port}")
+    print(f"Server is listening on {args.server_ip}:{args.server_port}")
     server.receive()
 
 if __name__ == '__main__':
@@ -1,168 +1,1094 @@
 import os
+import bisect
+import heapq
 import sys
+import argparse
+import json
+import multiprocessing
 import socket
 import hashlib
+import random
+import mmap
+import struct
+import zlib
 import time
-from collections import deque
+from collections import Counter, deque
 
-TOTAL_PACKET_SIZE = 1450
+TOTAL_PACKET_SIZE = 1450  # Proposed in the handshake when path MTU probes go unanswered
+MIN_PACKET_SIZE = 512
+MAX_PACKET_SIZE = 9000  # Jumbo frame payload, also the receive buffer for replies
+SESSION_ID_SIZE = 4
 SEQUENCE_NUM_SIZE = 4
-CHECKSUM_SIZE = 32
-HEADER_SIZE = SEQUENCE_NUM_SIZE + CHECKSUM_SIZE
-PAYLOAD_SIZE = TOTAL_PACKET_SIZE - HEADER_SIZE
+CHECKSUM_SIZE = 32  # SHA-256, protects the session start packet
 BYTE_ORDER = 'big'
-TIMEOUT = 1  # seconds
-WINDOW_SIZE = 10  # Number of packets that can be in-flight at once
+TIMEOUT = 1  # Initial retransmission timeout in seconds, before any RTT sample
+MIN_RTO = 0.01  # seconds
+ACK_DELAY = 0.002  # seconds the server holds back an ACK by default, assumed until its handshake reply says
+MAX_RTO = 60  # seconds
+WINDOW_SIZE = 10  # Initial congestion window in packets
+WINDOW_SIZE_SIZE = 4
+MAX_WINDOW = (TOTAL_PACKET_SIZE - SEQUENCE_NUM_SIZE - WINDOW_SIZE_SIZE) * 8  # Bounded by what one SACK bitmap can describe
+DUP_THRESHOLD = 3  # SACKed segments above a hole before it is considered lost
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)  # Linux UDP GSO, not exported by every Python build
+GSO_MAX_SEGMENTS = 64  # Kernel limit on datagrams per GSO send
+GSO_MAX_BYTES = 65000  # Stay under the 64 KiB UDP limit for one GSO send
+PACING_GAIN = 1.25  # Pacing rate over cwnd / srtt, a little above so the window can still fill
+PACING_GAIN_SLOW_START = 2.0  # Slow start doubles the window every RTT, the pacing rate has to keep up
+PACING_BURST = 8  # Packets that may leave back to back, keeps GSO batches worthwhile
+MAX_AUTO_BUFFER = 8 * 1024 * 1024  # Ceiling for auto-sized socket buffers, in bytes
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)  # Linux, exceeds net.core.wmem_max with CAP_NET_ADMIN
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)  # Linux DF control, not exported by every Python build
+IP_PMTUDISC_PROBE = getattr(socket, 'IP_PMTUDISC_PROBE', 3)  # Set DF and ignore the cached path MTU
+IP_MTU = getattr(socket, 'IP_MTU', 14)  # Route MTU of a connected socket
+IP_UDP_HEADER_SIZE = 28  # IPv4 and UDP headers around every datagram
+PROBE_SEQ_NUM = 0xFFFFFFFB  # Sequence number of a path MTU probe, answered with its size
+VERIFY_SEQ_NUM = 0xFFFFFFFA  # Sequence number of the whole-file check after a multi-stream transfer
+# Datagram sizes probed below the route MTU: IPv6 minimum, common tunnels, PPPoE, Ethernet and jumbo frames
+PROBE_SIZES = (1232, 1372, 1464, 1472, 4068, 8972)
+PROBE_ATTEMPTS = 3  # Rounds of probes before falling back to TOTAL_PACKET_SIZE
+EXCHANGE_ROUNDS = 5  # Times unanswered manifest or listing pages are sent before giving up on them
+PROBE_GRACE = 0.01  # seconds to wait for larger probes beyond twice the first echo's RTT
+PROTOCOL_VERSION = 3  # Sent in the handshake, the server refuses any other
+HANDSHAKE_SEQ_NUM = 0xFFFFFFFC  # Sequence number of the handshake and its reply, never a data segment or an ACK
+# Version, checksum proposal, flags, file size, the byte range this session carries, the FEC group size, packet
+# size and window, ahead of the file name in the handshake
+START_STRUCT = struct.Struct('!BBBQQQBHI')
+# Handshake sequence number, version, then the checksum, packet size and receive window the server took and the
+# longest it holds back an ACK, in microseconds
+HANDSHAKE_REPLY = struct.Struct('!IBBHII')
+START_FLAG_RESUME = 0x01  # Keep the server's existing file and only send blocks that differ
+START_FLAG_BATCH = 0x02  # The range is several files back to back, laid out by a listing sent before any data
+FEC_SEQ_FLAG = 0x80000000  # Marks an XOR parity packet, the rest of the sequence number is its group
+MAX_FEC_GROUP = 255  # Largest group size the start packet can carry
+MANIFEST_SEQ_NUM = 0xFFFFFFFE  # Sequence number of a block-hash manifest page, answered with a match bitmap
+BLOCK_SEGMENTS = 512  # Segments per manifest block
+BLOCK_HASH_SIZE = 8
+MANIFEST_PAGE_BLOCKS = 16  # Blocks hashed per manifest page, bounds the server's disk time per reply
+LISTING_SEQ_NUM = 0xFFFFFFFD  # Sequence number of a batch listing page, answered with its index and a status
+LISTING_ENTRY = struct.Struct('!QH')  # File size and path length, ahead of the relative path in a listing page
+SUMMARY_INTERVAL = 1  # seconds between progress lines
+SERIES_LENGTH = 600  # Samples kept per time series
+
+CHECKSUM_SHA256 = 0
+CHECKSUM_CRC32 = 1
+CHECKSUM_BLAKE2B64 = 2
+# Per-packet integrity checks, id -> (name, digest size, function), negotiated at session start
+CHECKSUMS = {
+    CHECKSUM_SHA256: ('sha256', 32, lambda data: hashlib.sha256(data).digest()),
+    CHECKSUM_CRC32: ('crc32', 4, lambda data: zlib.crc32(data).to_bytes(4, BYTE_ORDER)),
+    CHECKSUM_BLAKE2B64: ('blake2b64', 8, lambda data: hashlib.blake2b(data, digest_size=8).digest()),
+}
+CHECKSUM_IDS = {name: checksum_id for checksum_id, (name, _, _) in CHECKSUMS.items()}
+
+def set_buffer(sock, option: int, force_option: int, size: int):
+    # Ask for size bytes, past the sysctl limit when privileged, and return what the kernel granted
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    return sock.getsockopt(socket.SOL_SOCKET, option)
+
+def file_digest(path: str):
+    # SHA-256 of a whole file, read in 1 MiB chunks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def probe_path_mtu(sock, address, session_id: bytes, fallback: int):
+    # Packetization-layer path MTU discovery (RFC 8899): one DF datagram of every candidate size, the server
+    # echoes the size of each that arrives and the largest echoed is the biggest that passes unfragmented.
+    # The route MTU the kernel knows bounds the candidates, the probes find any smaller hop past it. Returns the
+    # size to propose, fallback if no probe is echoed, and the first round's RTT if one was measured.
+    limit = MAX_PACKET_SIZE
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as route:
+            route.connect(address)
+            limit = min(limit, route.getsockopt(socket.IPPROTO_IP, IP_MTU) - IP_UDP_HEADER_SIZE)
+    except OSError:
+        pass  # No route MTU on this platform, probe the whole ladder
+    sizes = sorted({size for size in PROBE_SIZES if MIN_PACKET_SIZE <= size < limit} | {limit})
+    try:
+        previous = sock.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    except OSError:
+        previous = None  # No DF control, a probe the network fragments passes as well
+    best = 0
+    first_rtt = None  # From the first round only, Karn: an echo after a resend is ambiguous
+    try:
+        for attempt in range(PROBE_ATTEMPTS):
+            start = time.time()
+            for size in sizes:
+                probe = session_id + PROBE_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                try:
+                    sock.sendto(probe + bytes(size - len(probe)), address)
+                except OSError:
+                    break  # EMSGSIZE, larger than a local link allows and so is every size after it
+            deadline = start + TIMEOUT
+            while best < sizes[-1] and time.time() < deadline:
+                sock.settimeout(max(deadline - time.time(), 0))
+                try:
+                    reply, _ = sock.recvfrom(MAX_PACKET_SIZE)
+                except (socket.timeout, BlockingIOError):
+                    break
+                if len(reply) != 2 * SEQUENCE_NUM_SIZE or int.from_bytes(reply[:SEQUENCE_NUM_SIZE], BYTE_ORDER) != PROBE_SEQ_NUM:
+                    continue
+                size = int.from_bytes(reply[SEQUENCE_NUM_SIZE:], BYTE_ORDER)
+                if size not in sizes:
+                    continue
+                if not best:
+                    # Larger probes left right behind the first, give them about one more RTT
+                    rtt = time.time() - start
+                    if not attempt:
+                        first_rtt = rtt
+                    deadline = min(deadline, time.time() + 2 * rtt + PROBE_GRACE)
+                best = max(best, size)
+            if best:
+                break
+    finally:
+        if previous is not None:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, previous)
+        sock.settimeout(TIMEOUT)
+    if best:
+        print(f"Path MTU probe: {best}-byte packets get through.")
+    else:
+        print(f"No answer to path MTU probes, proposing {fallback}-byte packets.")
+    return best or fallback, first_rtt
+
+class Stats:
+    """Transfer counters with RTT, goodput and window samples, in place of a log line per packet."""
+
+    def __init__(self, debug: bool = False, quiet: bool = False):
+        self.debug = debug  # Per-packet log lines, off unless asked for
+        self.quiet = quiet  # Sample without printing summary lines, for the stats of one session
+        self.counters = Counter()
+        self.rtt_histogram = Counter()  # Bucket upper bound in ms (a power of two) -> samples
+        self.goodput = deque(maxlen=SERIES_LENGTH)  # (seconds since start, bytes/s over the interval)
+        self.window = deque(maxlen=SERIES_LENGTH)  # (seconds since start, window in segments)
+        self.start = self.last_summary = time.time()
+        self.last_bytes = 0
+
+    def add_rtt(self, rtt: float):
+        self.rtt_histogram[1 << int(rtt * 1000).bit_length()] += 1
+
+    def tick(self, goodput_bytes: int, window=None):
+        # Called from the transfer loop, samples and prints a summary line once per interval
+        now = time.time()
+        if now - self.last_summary < SUMMARY_INTERVAL:
+            return
+        rate = (goodput_bytes - self.last_bytes) / (now - self.last_summary)
+        self.goodput.append((round(now - self.start, 3), round(rate)))
+        if window is not None:
+            self.window.append((round(now - self.start, 3), round(window, 1)))
+        self.last_summary = now
+        self.last_bytes = goodput_bytes
+        if self.quiet:
+            return
+        counters = ', '.join(f"{name} {value}" for name, value in sorted(self.counters.items()))
+        print(f"[{now - self.start:6.1f} s] {rate * 8 / 1e6:.2f} Mbit/s"
+              + (f", window {window:.1f}" if window is not None else "") + f", {counters}")
+
+    def as_dict(self):
+        return {
+            'elapsed': round(time.time() - self.start, 3),
+            'counters': dict(self.counters),
+            'rtt_histogram_ms': {str(bucket): count for bucket, count in sorted(self.rtt_histogram.items())},
+            'goodput': list(self.goodput),
+            'window': list(self.window),
+        }
+
+    def dump(self, path: str, **fields):
+        # One JSON record per transfer, appended so concurrent streams and sessions can share a file
+        record = json.dumps(dict(fields, **self.as_dict()))
+        if path == '-':
+            print(record)
+        else:
+            with open(path, 'a') as file:
+                file.write(record + '\n')
+
+class RttEstimator:
+    """Jacobson/Karels smoothed RTT and retransmission timeout (RFC 6298)."""
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = TIMEOUT
+        # The server delays ACKs for in-order data, the last segments of a flight may wait this long for
+        # theirs, so it is added on top of the variance as QUIC does (RFC 9002)
+        self.max_ack_delay = ACK_DELAY
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar + self.max_ack_delay, MIN_RTO), MAX_RTO)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+class Reno:
+    """Slow start followed by additive increase, multiplicative decrease."""
+
+    def __init__(self):
+        self.cwnd = float(WINDOW_SIZE)
+        self.ssthresh = float(MAX_WINDOW)
+
+    def on_ack(self, acked: int, rtt: float):
+        for _ in range(acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1.0
+
+class Cubic(Reno):
+    """CUBIC window growth (RFC 8312), independent of RTT once past slow start and never slower than Reno."""
+    C = 0.4
+    BETA = 0.7
+    ALPHA = 3 * (1 - BETA) / (1 + BETA)  # Additive increase per RTT that matches Reno's average rate under BETA
+
+    def __init__(self):
+        super().__init__()
+        self.w_max = 0.0
+        self.w_est = 0.0  # Window Reno would have reached since the epoch started (RFC 8312 section 4.2)
+        self.epoch_start = None
+
+    def on_ack(self, acked: int, rtt: float):
+        if self.cwnd < self.ssthresh or rtt is None:
+            # Without an RTT sample yet (everything so far was retransmitted) there is no curve to follow
+            return super().on_ack(acked, rtt)
+        now = time.time()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_max = max(self.w_max, self.cwnd)
+            self.w_est = self.cwnd
+        k = (self.w_max * (1 - self.BETA) / self.C) ** (1 / 3)
+        target = self.C * (now - self.epoch_start + rtt - k) ** 3 + self.w_max
+        self.w_est += acked * self.ALPHA / self.cwnd
+        if target > self.cwnd:
+            self.cwnd += acked * (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += acked * 0.01 / self.cwnd
+        # Reno-friendly region: small windows and short RTTs, where the cubic curve grows slower than Reno and
+        # would leave too few segments in flight for SACK to detect a loss before the timer does
+        self.cwnd = min(max(self.cwnd, self.w_est), MAX_WINDOW)
+
+    def on_loss(self):
+        self.w_max = self.cwnd
+        self.cwnd = max(self.cwnd * self.BETA, 2)
+        self.ssthresh = self.cwnd
+        self.epoch_start = None
+
+    def on_timeout(self):
+        self.on_loss()
+        self.cwnd = 1.0
+
+CONGESTION_CONTROLLERS = {'reno': Reno, 'cubic': Cubic}
+
+class Pacer:
+    """Token bucket that spreads a window over the RTT instead of sending it back to back."""
+
+    def __init__(self, pace: bool, rate_limit: float):
+        self.pace = pace  # Derive the rate from cwnd / srtt
+        self.rate_limit = rate_limit  # Hard cap in bytes per second, 0 for none
+        self.rate = 0.0  # Current rate in bytes per second, 0 sends unpaced
+        self.packet_size = TOTAL_PACKET_SIZE
+        self.tokens = 0.0  # Bytes that may be sent now, negative after a burst that overdrew the bucket
+        self.last = time.time()
+
+    def update(self, cwnd: float, srtt: float, slow_start: bool, packet_size: int):
+        self.packet_size = packet_size
+        rate = 0.0
+        if self.pace and srtt:
+            rate = (PACING_GAIN_SLOW_START if slow_start else PACING_GAIN) * cwnd * packet_size / srtt
+        if self.rate_limit:
+            rate = min(rate, self.rate_limit) if rate else self.rate_limit
+        self.rate = rate
+
+    def ready(self):
+        if not self.rate:
+            return True
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, PACING_BURST * self.packet_size)
+        self.last = now
+        return self.tokens > 0
+
+    def spend(self, nbytes: int):
+        if self.rate:
+            self.tokens -= nbytes
+
+    def delay(self):
+        # Seconds until the bucket allows the next packet
+        if not self.rate or self.tokens > 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+class Segments:
+    """Lazy, zero-copy view of a buffer as payload_size-sized segments."""
+
+    def __init__(self, data, payload_size: int):
+        self.view = memoryview(data)
+        self.payload_size = payload_size
+        self.count = (len(self.view) + payload_size - 1) // payload_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, seq_num):
+        return self.view[seq_num * self.payload_size:(seq_num + 1) * self.payload_size]
+
+    def read(self, pos: int, size: int):
+        return self.view[pos:pos + size]
+
+    def resize(self, payload_size: int):
+        self.payload_size = payload_size
+        self.count = (len(self.view) + payload_size - 1) // payload_size
+
+    def release(self):
+        self.view.release()
+
+class FileSegments:
+    """Files read back to back as one stream of payload_size-sized segments, which may span file boundaries."""
+
+    def __init__(self, files, payload_size: int):
+        self.paths = [path for path, _ in files]
+        self.sizes = [size for _, size in files]
+        self.starts = []  # Stream offset of each file, for bisect
+        length = 0
+        for size in self.sizes:
+            self.starts.append(length)
+            length += size
+        self.length = length
+        self.payload_size = payload_size
+        self.count = (length + payload_size - 1) // payload_size
+        self.fd = None  # Only the file being read is kept open, segments are mostly asked for in order
+        self.fd_index = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, seq_num):
+        return self.read(seq_num * self.payload_size, self.payload_size)
+
+    def read(self, pos: int, size: int):
+        size = min(size, self.length - pos)
+        pieces = []
+        index = bisect.bisect_right(self.starts, pos) - 1
+        while size > 0:
+            n = min(size, self.starts[index] + self.sizes[index] - pos)
+            if n > 0:
+                if index != self.fd_index:
+                    self.release()
+                    self.fd = os.open(self.paths[index], os.O_RDONLY)
+                    self.fd_index = index
+                # A file that shrank since it was listed reads as zeros, the digest check then fails the batch
+                pieces.append(os.pread(self.fd, n, pos - self.starts[index]).ljust(n, b'\0'))
+                pos += n
+                size -= n
+            index += 1
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = self.fd_index = None
 
 class Client:
-    def __init__(self, server_ip, server_port: int):
+    def __init__(self, server_ip, server_port: int, congestion_control: str = 'cubic', checksum: str = 'crc32',
+                 resume: bool = False, debug: bool = False, stats_file: str = None, fec_group: int = 0,
+                 pace: bool = False, rate_limit: float = 0, sndbuf: int = 0, rcvbuf: int = 0,
+                 packet_size: int = 0):
         self.server_ip = server_ip
         self.server_port = server_port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.client_socket.settimeout(TIMEOUT)
+        self.rtt = RttEstimator()
+        self.cc = CONGESTION_CONTROLLERS[congestion_control]()
+        self.tx_count = 0  # Transmission order, used to tell a lost packet from a reordered one
+        # Prefixes every packet so the server can tell concurrent transfers from one address apart
+        self.session_id = random.getrandbits(SESSION_ID_SIZE * 8).to_bytes(SESSION_ID_SIZE, BYTE_ORDER)
+        self.proposed_checksum = CHECKSUM_IDS[checksum]
+        self.proposed_packet_size = packet_size  # 0 probes the path for the largest one
+        # Data sent before the handshake reply (0-RTT) goes out under the proposal
+        self.use_settings(self.proposed_checksum, packet_size or TOTAL_PACKET_SIZE)
+        self.handshake = None  # Handshake packet until the server's reply, or an ACK of data, confirms it
+        self.handshake_resent = False
+        self.gso = sys.platform.startswith('linux')  # Cleared on the first send the kernel refuses
+        self.rwnd = WINDOW_SIZE  # Receive window advertised by the server, in segments
+        self.resume = resume
+        self.matched_blocks = set()  # Blocks the server already holds, never sent
+        self.fec_group = fec_group  # Data segments per XOR parity packet, 0 to rely on retransmission alone
+        # SHA-256 of the byte range, fed as segments are first read and checked by the server at EOF
+        self.digest = hashlib.sha256()
+        self.digested = 0  # Segments hashed so far
+        self.stats = Stats(debug)
+        self.stats_file = stats_file  # Where the JSON record of the transfer is appended, if anywhere
+        self.pacer = Pacer(pace, rate_limit)
+        # Socket buffers in bytes, 0 sizes them from the congestion window as it grows
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.buffer_size = 0  # Largest auto-sized buffer set so far
+        if sndbuf:
+            set_buffer(self.client_socket, socket.SO_SNDBUF, SO_SNDBUFFORCE, sndbuf)
+        if rcvbuf:
+            set_buffer(self.client_socket, socket.SO_RCVBUF, SO_RCVBUFFORCE, rcvbuf)
+
+    def use_settings(self, checksum_id: int, packet_size: int):
+        self.checksum_id = checksum_id
+        _, size, self.checksum = CHECKSUMS[checksum_id]
+        self.checksum_size = size
+        self.packet_size = packet_size
+        self.payload_size = packet_size - SESSION_ID_SIZE - SEQUENCE_NUM_SIZE - size
+        # Headers are packed in place into a ring with one slot per sequence number in flight
+        self.header_struct = struct.Struct(f'!{SESSION_ID_SIZE}sI{size}s')
+        self.headers = memoryview(bytearray(MAX_WINDOW * self.header_struct.size))
+
+    def size_buffers(self, window: float):
+        # The congestion window tracks the bandwidth-delay product, leave room for two of them each way since
+        # the kernel charges its own per-datagram overhead to the buffer too
+        size = min(int(window * 2 + 1) * self.packet_size, MAX_AUTO_BUFFER)
+        if size <= self.buffer_size:
+            return
+        self.buffer_size = size
+        if not self.sndbuf:
+            set_buffer(self.client_socket, socket.SO_SNDBUF, SO_SNDBUFFORCE, size)
+        if not self.rcvbuf:
+            set_buffer(self.client_socket, socket.SO_RCVBUF, SO_RCVBUFFORCE, size)
 
-    def split_data(self, data: bytes):
-        return [data[i:i + PAYLOAD_SIZE] for i in range(0, len(data), PAYLOAD_SIZE)]
+    def build_header(self, seq_num: int, segment):
+        offset = (seq_num % MAX_WINDOW) * self.header_struct.size
+        self.header_struct.pack_into(self.headers, offset, self.session_id, seq_num, self.checksum(segment))
+        return self.headers[offset:offset + self.header_struct.size]
 
-    def send_data(self, data: bytes):
-        segments = self.split_data(data)
+    def send_batch(self, packets):
+        # packets is a list of (header, segment) views, sent scatter-gather without joining them. With UDP GSO
+        # a run of full-size packets (the last may be short) leaves in one sendmsg and the kernel splits it.
+        address = (self.server_ip, self.server_port)
+        packet_size = self.header_struct.size + self.payload_size
+        self.stats.counters['packets_sent'] += len(packets)
+        i = 0
+        while i < len(packets):
+            end = i + 1
+            if self.gso:
+                limit = min(len(packets), i + GSO_MAX_SEGMENTS, i + GSO_MAX_BYTES // packet_size)
+                while end < limit and len(packets[end - 1][1]) == self.payload_size:
+                    end += 1
+            if end - i == 1:
+                self.client_socket.sendmsg(packets[i], (), 0, address)
+            else:
+                iov = [view for packet in packets[i:end] for view in packet]
+                try:
+                    self.client_socket.sendmsg(iov, [(socket.SOL_UDP, UDP_SEGMENT, struct.pack('=H', packet_size))],
+                                               0, address)
+                except OSError:
+                    self.gso = False  # Kernel or NIC without GSO, fall back to one datagram per call
+                    continue
+            i = end
+
+    def negotiate(self, file_name: bytes, file_size: int, offset: int, length: int, flags: int = 0,
+                  wait: bool = True):
+        # Handshake: version, checksum proposal, flags, file size, byte range, FEC group, packet size and window
+        # ahead of the file name, under SHA-256. The server answers with the settings it took. Without wait the
+        # first window of data follows straight away under the proposal (0-RTT) and the reply is picked out of
+        # the ACK stream.
+        if self.resume:
+            flags |= START_FLAG_RESUME
+        if not self.proposed_packet_size:
+            self.proposed_packet_size, rtt = probe_path_mtu(self.client_socket, (self.server_ip, self.server_port),
+                                                            self.session_id, TOTAL_PACKET_SIZE)
+            if rtt is not None:
+                self.rtt.sample(rtt)
+            self.use_settings(self.proposed_checksum, self.proposed_packet_size)
+        payload = START_STRUCT.pack(PROTOCOL_VERSION, self.proposed_checksum, flags, file_size, offset, length,
+                                    self.fec_group, self.proposed_packet_size, MAX_WINDOW) + file_name
+        self.handshake = (self.session_id + HANDSHAKE_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                          + hashlib.sha256(payload).digest() + payload)
+        self.handshake_time = time.time()
+        self.client_socket.sendto(self.handshake, (self.server_ip, self.server_port))
+        while wait and self.handshake is not None:
+            self.client_socket.settimeout(self.rtt.rto)
+            try:
+                reply, _ = self.client_socket.recvfrom(MAX_PACKET_SIZE)
+                self.take_handshake_reply(reply)
+            except socket.timeout:
+                print("Timeout for handshake, resending...")
+                self.resend_handshake()
+
+    def resend_handshake(self):
+        self.rtt.backoff()
+        self.handshake_resent = True
+        self.client_socket.sendto(self.handshake, (self.server_ip, self.server_port))
+
+    def take_handshake_reply(self, reply: bytes):
+        # None if reply is not the handshake reply, otherwise whether the server kept the proposed settings
+        body = reply[CHECKSUM_SIZE:]
+        if len(body) != HANDSHAKE_REPLY.size or hashlib.sha256(body).digest() != reply[:CHECKSUM_SIZE]:
+            return None
+        sequence_number, version, checksum_id, packet_size, rwnd, ack_delay = HANDSHAKE_REPLY.unpack(body)
+        if sequence_number != HANDSHAKE_SEQ_NUM or version != PROTOCOL_VERSION or checksum_id not in CHECKSUMS:
+            return None
+        if self.handshake is None:
+            return True  # Duplicate reply, or data ACKs already confirmed the settings
+        self.rtt.max_ack_delay = ack_delay / 1e6
+        if not self.handshake_resent:
+            self.rtt.sample(time.time() - self.handshake_time)  # Karn: a resent handshake is ambiguous
+        self.handshake = None
+        self.rwnd = rwnd
+        kept = (checksum_id, packet_size) == (self.checksum_id, self.packet_size)
+        if not kept:
+            self.use_settings(checksum_id, packet_size)
+        print(f"Using {CHECKSUMS[checksum_id][0]} per-packet checksum, {packet_size}-byte packets, "
+              f"receive window {rwnd}.")
+        return kept
+
+    def open_reply(self, reply: bytes):
+        # Every reply after the handshake leads with the session checksum of the rest, a damaged one is dropped
+        # here, a flipped bit in a cumulative ACK would otherwise free segments the server never got
+        body = reply[self.checksum_size:]
+        if len(reply) < self.checksum_size or self.checksum(body) != reply[:self.checksum_size]:
+            self.stats.counters['reply_checksum_failures'] += 1
+            return None
+        return body
+
+    def next_tx(self):
+        self.tx_count += 1
+        return self.tx_count
+
+    def parse_ack(self, ack: bytes):
+        # ACK = signed cumulative ACK, the receive window, then a bitmap of segments received past the first hole
+        ack_sequence_number = int.from_bytes(ack[:SEQUENCE_NUM_SIZE], BYTE_ORDER, signed=True)
+        if len(ack) >= SEQUENCE_NUM_SIZE + WINDOW_SIZE_SIZE:
+            self.rwnd = int.from_bytes(ack[SEQUENCE_NUM_SIZE:SEQUENCE_NUM_SIZE + WINDOW_SIZE_SIZE], BYTE_ORDER)
+        bitmap = int.from_bytes(ack[SEQUENCE_NUM_SIZE + WINDOW_SIZE_SIZE:], 'little')
+        # Peel off the lowest set bit each round, so the cost follows the SACKed segments, not the window
+        sacked = []
+        while bitmap:
+            lowest = bitmap & -bitmap
+            sacked.append(ack_sequence_number + 1 + lowest.bit_length())
+            bitmap ^= lowest
+        return ack_sequence_number, sacked
+
+    def exchange_manifest(self, segments):
+        # Send the hash of every block of our range in pages, the server compares them with what it has on
+        # disk, answers each page with a bitmap of matching blocks and counts those segments as received
+        block_count = (len(segments) + BLOCK_SEGMENTS - 1) // BLOCK_SEGMENTS
+        per_page = min((self.payload_size - SEQUENCE_NUM_SIZE) // BLOCK_HASH_SIZE, MANIFEST_PAGE_BLOCKS)
+        pending = {}
+        for first in range(0, block_count, per_page):
+            payload = first.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+            for block in range(first, min(first + per_page, block_count)):
+                start = block * BLOCK_SEGMENTS * segments.payload_size
+                content = segments.read(start, BLOCK_SEGMENTS * segments.payload_size)
+                payload += hashlib.blake2b(content, digest_size=BLOCK_HASH_SIZE).digest()
+                self.digest.update(content)  # Blocks are read in order here, skipped ones included
+            pending[first] = (self.session_id + MANIFEST_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                              + self.checksum(payload) + payload)
+        self.digested = len(segments)
+
+        for _ in range(EXCHANGE_ROUNDS):
+            if not pending:
+                break
+            for packet in pending.values():
+                self.client_socket.sendto(packet, (self.server_ip, self.server_port))
+            # The server reads and hashes every block before answering, allow for disk time on top of the RTT
+            self.client_socket.settimeout(max(self.rtt.rto, TIMEOUT))
+            try:
+                while pending:
+                    reply = self.open_reply(self.client_socket.recvfrom(MAX_PACKET_SIZE)[0])
+                    if reply is None or int.from_bytes(reply[:SEQUENCE_NUM_SIZE], BYTE_ORDER) != MANIFEST_SEQ_NUM:
+                        continue
+                    first = int.from_bytes(reply[SEQUENCE_NUM_SIZE:2 * SEQUENCE_NUM_SIZE], BYTE_ORDER)
+                    if pending.pop(first, None) is None:
+                        continue
+                    bitmap = int.from_bytes(reply[2 * SEQUENCE_NUM_SIZE:], 'little')
+                    self.matched_blocks.update(first + i for i in range(bitmap.bit_length()) if bitmap >> i & 1)
+            except socket.timeout:
+                self.rtt.backoff()
+                print(f"Timeout for {len(pending)} manifest pages, resending...")
+        if pending:
+            # Blocks of unanswered pages are simply sent again, the server overwrites them in place
+            print(f"No answer to {len(pending)} manifest pages, sending their blocks.")
+        print(f"Resuming: {len(self.matched_blocks)} of {block_count} blocks already on the server.")
+
+    def exchange_listing(self, entries):
+        # Send the relative path and size of every file of a batch in pages, the server lays the range out over
+        # them once it has all pages. Returns False if it refused the listing, None if it never answered.
+        room = self.payload_size - 2 * SEQUENCE_NUM_SIZE
+        pages = [b'']
+        for path, size in entries:
+            entry = LISTING_ENTRY.pack(size, len(path)) + path
+            if len(entry) > room:
+                raise ValueError(f"Path too long for a listing page: {path.decode('utf-8')}")
+            if len(pages[-1]) + len(entry) > room:
+                pages.append(b'')
+            pages[-1] += entry
+        count = len(pages).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+        pending = {}
+        for index, page in enumerate(pages):
+            payload = index.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + count + page
+            pending[index] = (self.session_id + LISTING_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                              + self.checksum(payload) + payload)
+
+        for _ in range(EXCHANGE_ROUNDS):
+            if not pending:
+                return True
+            for packet in pending.values():
+                self.client_socket.sendto(packet, (self.server_ip, self.server_port))
+            # The last page makes the server create every file, allow for disk time on top of the RTT
+            self.client_socket.settimeout(max(self.rtt.rto, TIMEOUT))
+            try:
+                while pending:
+                    reply = self.open_reply(self.client_socket.recvfrom(MAX_PACKET_SIZE)[0])
+                    if reply is None or len(reply) != 2 * SEQUENCE_NUM_SIZE + 1 \
+                            or int.from_bytes(reply[:SEQUENCE_NUM_SIZE], BYTE_ORDER) != LISTING_SEQ_NUM:
+                        continue
+                    if not reply[2 * SEQUENCE_NUM_SIZE]:
+                        return False
+                    pending.pop(int.from_bytes(reply[SEQUENCE_NUM_SIZE:2 * SEQUENCE_NUM_SIZE], BYTE_ORDER), None)
+            except socket.timeout:
+                self.rtt.backoff()
+                print(f"Timeout for {len(pending)} listing pages, resending...")
+        return None if pending else True
+
+    def skip_matched(self, seq_num: int, end: int):
+        # First sequence number at or after seq_num that is not in a block the server already holds
+        while seq_num < end and seq_num // BLOCK_SEGMENTS in self.matched_blocks:
+            seq_num = (seq_num // BLOCK_SEGMENTS + 1) * BLOCK_SEGMENTS
+        return min(seq_num, end)
+
+    def build_parity(self, segments, group: int):
+        # XOR of the group's segments, the short last one zero-padded, lets the server rebuild any single one
+        first = group * self.fec_group
+        value = 0
+        for seq_num in range(first, min(first + self.fec_group, len(segments))):
+            value ^= int.from_bytes(segments[seq_num], 'little')
+        parity = value.to_bytes(self.payload_size, 'little')
+        return self.header_struct.pack(self.session_id, FEC_SEQ_FLAG | group, self.checksum(parity)), parity
+
+    def split_data(self, data):
+        # Segments are sliced on demand, so only the in-flight window is ever copied
+        return Segments(data, self.payload_size)
+
+    def send_data(self, segments):
         base = 0  # First unacknowledged packet
         next_seq_num = 0  # Next packet to send
+        recovery_point = 0  # Losses below this were already answered with a window reduction
         
-        window = {}  # Map of sequence number to (packet, last_sent_time, original_segment)
+        window = {}  # Map of sequence number to (header, last_sent_time, segment, tx_order, retries)
+        # Min-heap of (deadline, tx_order, sequence number), one per transmission. An entry goes stale once its
+        # segment is ACKed or sent again, and is dropped when it reaches the top.
+        timers = []
+        last_progress = time.time()  # Last time an ACK freed anything, timers only fire after RTO without one
+        if self.resume and len(segments):
+            self.exchange_manifest(segments)
+        base = next_seq_num = self.skip_matched(0, len(segments))
         
         while base < len(segments):
-            # Send packets within the window
-            if next_seq_num % 10 == 0:
-                print(f"Sending segments from {next_seq_num} to {min(base + WINDOW_SIZE, len(segments)) - 1}")
+            # Send packets within the congestion window and the server's receive window
+            self.stats.tick(self.stats.counters['bytes_acked'], self.cc.cwnd)
+            if self.stats.debug:
+                print(f"Sending segments from {next_seq_num} (cwnd {self.cc.cwnd:.1f}, rto {self.rtt.rto * 1000:.1f} ms)")
             
-            while next_seq_num < len(segments) and next_seq_num < base + WINDOW_SIZE:
+            self.size_buffers(self.cc.cwnd)
+            self.pacer.update(self.cc.cwnd, self.rtt.srtt, self.cc.cwnd < self.cc.ssthresh, self.packet_size)
+            batch = []
+            while (next_seq_num < len(segments) and len(window) < int(self.cc.cwnd)
+                   and next_seq_num < base + min(self.rwnd, MAX_WINDOW) and self.pacer.ready()):
                 segment = segments[next_seq_num]
-                checksum = hashlib.sha256(segment).digest()
-                header = next_seq_num.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + checksum
-                packet = header + segment
-                     
-                self.client_socket.sendto(packet, (self.server_ip, self.server_port))
-                # Store the original segment to enable correct retransmission
-                window[next_seq_num] = (packet, time.time(), segment)
+                if next_seq_num == self.digested:
+                    self.digest.update(segment)
+                    self.digested += 1
+                header = self.build_header(next_seq_num, segment)
+                batch.append((header, segment))
+                self.pacer.spend(len(header) + len(segment))  # Per packet, so one batch stays within the burst
+                # Keep the header and segment views, a retransmission resends them as they are
+                tx = self.next_tx()
+                now = time.time()
+                window[next_seq_num] = (header, now, segment, tx, 0)
+                heapq.heappush(timers, (now + self.rtt.rto, tx, next_seq_num))
+                # Parity follows the last segment of each group. It is never retransmitted, a loss it cannot
+                # cover is left to the usual SACK and timeout recovery.
+                if self.fec_group and ((next_seq_num + 1) % self.fec_group == 0 or next_seq_num + 1 == len(segments)):
+                    batch.append(self.build_parity(segments, next_seq_num // self.fec_group))
+                    self.pacer.spend(sum(map(len, batch[-1])))
+                    self.stats.counters['parity_sent'] += 1
 
-                next_seq_num += 1
+                next_seq_num = self.skip_matched(next_seq_num + 1, len(segments))
+            self.send_batch(batch)
             
-            # Try to receive ACKs
+            # Wait for ACKs until the earliest live retransmission deadline, not a fixed timeout
+            while timers and (timers[0][2] not in window or window[timers[0][2]][3] != timers[0][1]):
+                heapq.heappop(timers)
+            wait = timers[0][0] - time.time() if timers else self.rtt.rto
+            if next_seq_num < len(segments) and len(window) < int(self.cc.cwnd):
+                wait = min(wait, self.pacer.delay())  # Held back by pacing, not by the window
+            self.client_socket.settimeout(max(wait, 0))  # 0 polls: take a queued ACK before declaring a timeout
             try:
-                ack, _ = self.client_socket.recvfrom(SEQUENCE_NUM_SIZE)
-                ack_sequence_number = int.from_bytes(ack, BYTE_ORDER)
-                
-                print(f"Received ACK for segment {ack_sequence_number}")
+                ack, _ = self.client_socket.recvfrom(MAX_PACKET_SIZE)
+                kept = self.take_handshake_reply(ack) if self.handshake is not None else None
+                if kept is not None:
+                    if not kept:
+                        # The server took other settings, whatever went out ahead of its reply is void
+                        segments.resize(self.payload_size)
+                        window.clear()
+                        timers.clear()
+                        base = next_seq_num = 0
+                        self.digest = hashlib.sha256()
+                        self.digested = 0
+                    continue
+                ack = self.open_reply(ack)
+                if ack is None:
+                    continue
+                ack_sequence_number, sacked = self.parse_ack(ack)
+                if ack_sequence_number >= 0 or sacked:
+                    self.handshake = None  # Data was taken under the proposed settings, the reply is not needed
+                self.stats.counters['acks_received'] += 1
+                if self.stats.debug:
+                    print(f"Received ACK for segment {ack_sequence_number}")
                 
-                # Handle ACK and update the window
+                # Handle ACK and update the window, freed entries feed the RTT estimator and the
+                # congestion controller
+                freed = []
                 if ack_sequence_number >= base:
-                    # Cumulative ACK - acknowledge all packets up to ack_sequence_number
-                    for seq_num in list(window.keys()):
-                        if seq_num <= ack_sequence_number:
-                            del window[seq_num]
-                    base = ack_sequence_number + 1
-                elif ack_sequence_number < base:
-                    
-                    if base - ack_sequence_number > 1:  # More than one packet gap
-
-                        # Reset next_seq_num to retransmit from the ACK+1 position
-                        potential_rollback = ack_sequence_number + 1
-                        if potential_rollback < next_seq_num:
-                            # Only roll back if it's less than our current position
-                            next_seq_num = potential_rollback
-                            
-                            # We should regenerate packets for numbers that might be missing from window
-                            for seq_to_fix in range(potential_rollback, min(base + WINDOW_SIZE, len(segments))):
-                                if seq_to_fix not in window:
-                                    # Regenerate the packet properly with correct checksum
-                                    segment = segments[seq_to_fix]
-                                    checksum = hashlib.sha256(segment).digest()
-                                    header = seq_to_fix.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + checksum
-                                    packet = header + segment
-                                    window[seq_to_fix] = (packet, time.time(), segment)
-                  
+                    # Cumulative ACK - acknowledge all packets up to ack_sequence_number. The window is keyed in
+                    # sending order, which is sequence order, so this stops at the first one still outstanding.
+                    acked = []
+                    for seq_num in window:
+                        if seq_num > ack_sequence_number:
+                            break
+                        acked.append(seq_num)
+                    freed = [window.pop(seq_num) for seq_num in acked]
+                    base = self.skip_matched(ack_sequence_number + 1, len(segments))
+                    next_seq_num = max(next_seq_num, base)
+
+                # Selective ACK - drop segments the server already buffered out of order
+                for seq_num in sacked:
+                    if seq_num in window:
+                        freed.append(window.pop(seq_num))
+
+                current_time = time.time()
+                newest_sacked_tx = max((entry[3] for entry in freed), default=-1)
+                # Karn's algorithm: only time segments that were never retransmitted
+                samples = [entry for entry in freed if entry[4] == 0]
+                if samples:
+                    rtt = current_time - max(samples, key=lambda entry: entry[3])[1]
+                    self.rtt.sample(rtt)
+                    self.stats.add_rtt(rtt)
+                if freed:
+                    last_progress = current_time
+                    self.cc.on_ack(len(freed), self.rtt.srtt)
+                    self.stats.counters['bytes_acked'] += sum(len(entry[2]) for entry in freed)
+
+                # Retransmit only the holes that were overtaken by at least DUP_THRESHOLD SACKed segments
+                if len(sacked) >= DUP_THRESHOLD:
+                    batch = []
+                    # Entries are only replaced below, never added or removed, so the window is walked in place
+                    for seq_num, (header, last_sent_time, segment, tx, retries) in window.items():
+                        if seq_num >= sacked[-DUP_THRESHOLD]:
+                            break  # Too few SACKed segments above this one and everything after it
+                        above = len(sacked) - bisect.bisect_right(sacked, seq_num)
+                        if above >= DUP_THRESHOLD and tx < newest_sacked_tx:
+                            if seq_num >= recovery_point:
+                                # First loss in this window of data, back off once
+                                self.cc.on_loss()
+                                recovery_point = next_seq_num
+                            batch.append((header, segment))
+                            tx = self.next_tx()
+                            window[seq_num] = (header, current_time, segment, tx, retries + 1)
+                            heapq.heappush(timers, (current_time + self.rtt.rto, tx, seq_num))
+                    self.stats.counters['retransmissions'] += len(batch)
+                    self.pacer.spend(sum(len(header) + len(segment) for header, segment in batch))
+                    self.send_batch(batch)
                 
-            except socket.timeout:
-                # Timeout occurred, check if we need to resend any packets
+            except (socket.timeout, BlockingIOError):
+                # Resend the segments whose timers ran out, popped from the heap instead of scanning the window
                 current_time = time.time()
-                for seq_num, (packet, last_sent_time, original_segment) in list(window.items()):
-                    if current_time - last_sent_time > TIMEOUT:
-                   
-                        # Regenerate the packet with correct headers to avoid propagating corrupted packets
-                        checksum = hashlib.sha256(original_segment).digest()
-                        header = seq_num.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + checksum
-                        fresh_packet = header + original_segment
-                        
-                        self.client_socket.sendto(fresh_packet, (self.server_ip, self.server_port))
-                        window[seq_num] = (fresh_packet, current_time, original_segment)
+                expired = []
+                while timers and timers[0][0] <= current_time:
+                    _, tx, seq_num = heapq.heappop(timers)
+                    if seq_num not in window or window[seq_num][3] != tx:
+                        continue
+                    if last_progress + self.rtt.rto > current_time:
+                        # ACKs are still coming in, push the deadline back as RFC 6298 restarts its timer on
+                        # every ACK of new data, and leave the hole to SACK recovery
+                        heapq.heappush(timers, (last_progress + self.rtt.rto, tx, seq_num))
+                        continue
+                    expired.append(seq_num)
+                if expired and self.handshake is not None:
+                    self.resend_handshake()  # Nothing was ACKed yet, the handshake may be what got lost
+                if expired:
+                    self.stats.counters['timeouts'] += 1
+                    self.stats.counters['retransmissions'] += len(expired)
+                    self.rtt.backoff()
+                    self.cc.on_timeout()
+                    recovery_point = next_seq_num
+                batch = []
+                for seq_num in expired:
+                    header, last_sent_time, segment, tx, retries = window[seq_num]
+                    batch.append((header, segment))
+                    tx = self.next_tx()
+                    window[seq_num] = (header, current_time, segment, tx, retries + 1)
+                    heapq.heappush(timers, (current_time + self.rtt.rto, tx, seq_num))
+                self.pacer.spend(sum(len(header) + len(segment) for header, segment in batch))
+                self.send_batch(batch)
             
             
         
+        segments.release()
         return next_seq_num  # Return last sequence number for EOF
 
     def send_eof(self, sequence_number):
-        eof_packet = sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + hashlib.sha256(b'').digest() + b''
+        # EOF carries the digest of the range, the server answers with the sequence number and 1 if its own
+        # digest of what it wrote matches, 0 otherwise. Late data ACKs are skipped, not counted as failures.
+        payload = self.digest.digest()
+        eof_packet = self.session_id + sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + self.checksum(payload) + payload
         retry_count = 0
         max_retries = 5
         
         while retry_count < max_retries:
             self.client_socket.sendto(eof_packet, (self.server_ip, self.server_port))
+            self.client_socket.settimeout(max(self.rtt.rto, MIN_RTO))
             try:
-                ack, _ = self.client_socket.recvfrom(SEQUENCE_NUM_SIZE)
-                ack_sequence_number = int.from_bytes(ack, BYTE_ORDER)
-                if ack_sequence_number == sequence_number:
-                    print("EOF sent and acknowledged.")
-                    return True
-                else:
-                    print("Incorrect ACK for EOF, resending...")
+                while True:
+                    ack = self.open_reply(self.client_socket.recvfrom(MAX_PACKET_SIZE)[0])
+                    if ack is not None and len(ack) == SEQUENCE_NUM_SIZE + 1 and int.from_bytes(ack[:SEQUENCE_NUM_SIZE], BYTE_ORDER) == sequence_number:
+                        print("EOF sent and acknowledged.")
+                        return ack[SEQUENCE_NUM_SIZE] == 1
             except socket.timeout:
+                self.rtt.backoff()
                 print("Timeout for EOF, resending...")
             
             retry_count += 1
         
         print("Failed to confirm EOF after maximum retries")
-        return False
+        return None
+
+    def verify_file(self, file_path: str, digest: bytes):
+        # Ask the server to hash its copy of the whole file, outside any session. Returns whether it matched
+        # digest, None without an answer.
+        payload = digest + os.path.basename(file_path).encode("utf-8")
+        packet = (self.session_id + VERIFY_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                  + hashlib.sha256(payload).digest() + payload)
+        for attempt in range(EXCHANGE_ROUNDS):
+            self.client_socket.sendto(packet, (self.server_ip, self.server_port))
+            # The server reads the whole file before answering, give it longer each time
+            self.client_socket.settimeout(TIMEOUT * (attempt + 1))
+            try:
+                while True:
+                    reply = self.client_socket.recvfrom(MAX_PACKET_SIZE)[0]
+                    body = reply[CHECKSUM_SIZE:]
+                    if len(body) == SEQUENCE_NUM_SIZE + 1 and hashlib.sha256(body).digest() == reply[:CHECKSUM_SIZE] \
+                            and int.from_bytes(body[:SEQUENCE_NUM_SIZE], BYTE_ORDER) == VERIFY_SEQ_NUM:
+                        return body[SEQUENCE_NUM_SIZE] == 1
+            except socket.timeout:
+                print("Timeout for the whole-file check, resending...")
+        return None
 
-    def send(self, file_path: str):
+    def send(self, file_path: str, offset: int = 0, length: int = None):
         file_name = os.path.basename(file_path).encode("utf-8")
         print(f"Sending file name: {file_name.decode('utf-8')}")
-        last_seq = self.send_data(file_name)
-
         start_time = time.time()
         
         with open(file_path, 'rb') as file:
-            content = file.read()
-            print(f"Sending file content ({len(content)} bytes).")
-            last_seq = self.send_data(content)
+            size = os.fstat(file.fileno()).st_size
+            if length is None:
+                length = size - offset
+            # Resume has to know the payload size before it can hash blocks, and an empty range has no data
+            # to confirm the handshake with, both wait for the reply
+            self.negotiate(file_name, size, offset, length, wait=self.resume or length == 0)
+            print(f"Sending file content ({length} bytes from offset {offset}).")
+            if length == 0:
+                last_seq = self.send_data(self.split_data(b''))
+            else:
+                # Map the file instead of reading it, segments are paged in as the window advances
+                content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    last_seq = self.send_data(self.split_data(memoryview(content)[offset:offset + length]))
+                finally:
+                    try:
+                        content.close()
+                    except BufferError:
+                        pass  # Segment views are still held by an exception's traceback, the map goes with them
         
         print("Sending EOF.")
         
         
-        if self.send_eof(last_seq):
-            print("File sent successfully.")
-            print(hashlib.sha256(open(file_path, 'rb').read()).hexdigest())
-        else:
+        verified = self.send_eof(last_seq)
+        sent = bool(verified)
+        if verified is None:
             print("File transmission may not have completed successfully.")
+        elif not verified:
+            print("Server copy does not match the file.")
+        elif length == size:
+            print("File sent and verified successfully.")
+            print(self.digest.hexdigest())
+        else:
+            print(f"Bytes {offset}-{offset + length} sent and verified successfully.")
             
         elapsed = time.time() - start_time
         print(f"Total time taken: {elapsed:.2f} seconds")
+        if self.stats_file:
+            self.stats.dump(self.stats_file, file=file_name.decode('utf-8'), offset=offset, length=length, ok=sent)
         
         self.client_socket.close()
+        return sent
+
+    def send_files(self, paths):
+        # Files and directory trees in one session: a listing of relative paths and sizes, then the content of
+        # every file back to back, so small files share segments instead of each paying for a session
+        files = []
+        entries = []
+        for path in paths:
+            parent = os.path.dirname(os.path.abspath(path))
+            if os.path.isdir(path):
+                names = []
+                for directory, subdirectories, file_names in os.walk(path):
+                    subdirectories.sort()
+                    names.extend(os.path.join(directory, name) for name in sorted(file_names))
+            else:
+                names = [path]
+            for name in names:
+                size = os.path.getsize(name)
+                relative = os.path.relpath(os.path.abspath(name), parent).replace(os.sep, '/')
+                files.append((name, size))
+                entries.append((relative.encode("utf-8"), size))
+        names = [name for name, _ in entries]
+        if len(set(names)) != len(names):
+            # a/x and b/x both land as x, the second would overwrite the first on the server
+            duplicates = sorted({name.decode("utf-8") for name in names if names.count(name) > 1})
+            print(f"Refusing to send a batch that names {', '.join(duplicates)} more than once.")
+            self.client_socket.close()
+            return False
+        length = sum(size for _, size in files)
+        label = os.path.basename(os.path.abspath(paths[0])).encode("utf-8")
+        print(f"Sending batch of {len(files)} files ({length} bytes).")
+        start_time = time.time()
+
+        self.negotiate(label, length, 0, length, START_FLAG_BATCH)
+        accepted = self.exchange_listing(entries)
+        if not accepted:
+            print("Server refused the batch listing." if accepted is not None else "No answer to the batch listing.")
+            self.client_socket.close()
+            return False
+        last_seq = self.send_data(FileSegments(files, self.payload_size))
+
+        print("Sending EOF.")
+        verified = self.send_eof(last_seq)
+        if verified is None:
+            print("Batch transmission may not have completed successfully.")
+        elif not verified:
+            print("Server copy does not match the files.")
+        else:
+            print(f"Batch of {len(files)} files sent and verified successfully.")
+            print(self.digest.hexdigest())
+        elapsed = time.time() - start_time
+        print(f"Total time taken: {elapsed:.2f} seconds")
+        if self.stats_file:
+            self.stats.dump(self.stats_file, file=label.decode('utf-8'), files=len(files), length=length,
+                            ok=bool(verified))
+        self.client_socket.close()
+        return bool(verified)
+
+def send_stream(client_args: tuple, file_path: str, offset: int, length: int):
+    # Worker process body for one byte range of a multi-stream transfer
+    client = Client(*client_args)
+    sys.exit(0 if client.send(file_path, offset, length) else 1)
+
+def send_parallel(client_args: tuple, file_path: str, streams: int):
+    # Split the file into one byte range per stream, each sent by its own process over its own socket. Every
+    # stream has its range verified at EOF, then the reassembled file is confirmed with a whole-file digest.
+    start_time = time.time()
+    size = os.path.getsize(file_path)
+    chunk = max(-(-size // streams), 1)
+    workers = [multiprocessing.Process(target=send_stream, args=(client_args, file_path, offset, min(chunk, size - offset)))
+               for offset in range(0, max(size, 1), chunk)]
+    for worker in workers:
+        worker.start()
+    digest = file_digest(file_path)  # While the streams run
+    for worker in workers:
+        worker.join()
+    verified = all(worker.exitcode == 0 for worker in workers)
+    if verified:
+        client = Client(*client_args)
+        verified = client.verify_file(file_path, digest)
+        client.client_socket.close()
+        if verified is None:
+            print("No answer to the whole-file check.")
+        elif not verified:
+            print("Server copy does not match the file.")
+    if verified:
+        print("File sent and verified successfully.")
+        print(digest.hex())
+    else:
+        print("File transmission may not have completed successfully.")
+    verified = bool(verified)
+    print(f"Total time taken over {len(workers)} streams: {time.time() - start_time:.2f} seconds")
+    return verified
 
 def main():
-    if len(sys.argv) < 4:
-        print(f"Usage: {sys.argv[0]} <file_path> <server_ip> <server_port>")
-        sys.exit(1)
-
-    file_path = sys.argv[1]
-    server_ip = sys.argv[2]
-    server_port = int(sys.argv[3])
-
-    client = Client(server_ip, server_port)
-    client.send(file_path)
-    
-    return 0
+    parser = argparse.ArgumentParser(description="Send a file to a URFT server using a pipelined window.")
+    parser.add_argument('file_path', nargs='+',
+                        help="file to send, or several files and directories to send as one batch")
+    parser.add_argument('server_ip')
+    parser.add_argument('server_port', type=int)
+    parser.add_argument('--cc', choices=sorted(CONGESTION_CONTROLLERS), default='cubic',
+                        help="congestion control algorithm (default: cubic)")
+    parser.add_argument('--checksum', choices=sorted(CHECKSUM_IDS), default='crc32',
+                        help="per-packet checksum to propose to the server (default: crc32)")
+    parser.add_argument('--streams', type=int, default=1,
+                        help="send byte ranges of the file in parallel over this many sockets (default: 1)")
+    parser.add_argument('--resume', action='store_true',
+                        help="keep the server's existing copy and only send blocks that differ from it")
+    parser.add_argument('--fec', type=int, default=0, metavar='K',
+                        help="send an XOR parity packet after every K data segments, so the server rebuilds a single "
+                             "loss per group without a retransmission (default: 0, off)")
+    parser.add_argument('--pace', action='store_true',
+                        help="spread each window over the RTT instead of sending it in one burst")
+    parser.add_argument('--rate-limit', type=float, default=0, metavar='MBPS',
+                        help="never send faster than this many Mbit/s (default: 0, no limit)")
+    parser.add_argument('--sndbuf', type=int, default=0, metavar='BYTES',
+                        help="socket send buffer size (default: 0, sized from the congestion window)")
+    parser.add_argument('--rcvbuf', type=int, default=0, metavar='BYTES',
+                        help="socket receive buffer size (default: 0, sized from the congestion window)")
+    parser.add_argument('--packet-size', type=int, default=0, metavar='BYTES',
+                        help="datagram size to propose to the server, headers included (default: 0, the largest "
+                             "that passes a path MTU probe)")
+    parser.add_argument('--debug', action='store_true', help="log every packet and ACK")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="append a JSON record of the transfer to FILE ('-' for stdout)")
+    args = parser.parse_args()
+    if not 0 <= args.fec <= MAX_FEC_GROUP:
+        parser.error(f"--fec must be between 0 and {MAX_FEC_GROUP}")
+    if args.packet_size and not MIN_PACKET_SIZE <= args.packet_size <= MAX_PACKET_SIZE:
+        parser.error(f"--packet-size must be between {MIN_PACKET_SIZE} and {MAX_PACKET_SIZE}")
+
+    client_args = (args.server_ip, args.server_port, args.cc, args.checksum, args.resume, args.debug, args.stats,
+                   args.fec, args.pace, args.rate_limit * 1e6 / 8, args.sndbuf, args.rcvbuf, args.packet_size)
+    batch = len(args.file_path) > 1 or os.path.isdir(args.file_path[0])
+    if batch and args.streams > 1:
+        parser.error("--streams splits a single file, it cannot be combined with a batch")
+
+    if batch:
+        sent = Client(*client_args).send_files(args.file_path)
+    elif args.streams > 1:
+        sent = send_parallel(client_args, args.file_path[0], args.streams)
+    else:
+        client = Client(*client_args)
+        sent = client.send(args.file_path[0])
+    sys.exit(0 if sent else 1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
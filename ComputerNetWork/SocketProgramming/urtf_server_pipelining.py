@@ -1,141 +1,797 @@
 import os
-import sys
+import bisect
 import socket
 import hashlib
 import time
+import struct
+import argparse
+import json
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
-TOTAL_PACKET_SIZE = 1450
+from urtf_client_pipelining import CHECKSUM_SHA256, CHECKSUMS, Stats, file_digest, set_buffer
+
+TOTAL_PACKET_SIZE = 1450  # Packet size the receive buffer is sized for, each client proposes its own
+MIN_PACKET_SIZE = 512
+MAX_PACKET_SIZE = 9000  # Largest packet size granted, jumbo frame payload
+SESSION_ID_SIZE = 4
 SEQUENCE_NUM_SIZE = 4
-CHECKSUM_SIZE = 32
-HEADER_SIZE = SEQUENCE_NUM_SIZE + CHECKSUM_SIZE
-PAYLOAD_SIZE = TOTAL_PACKET_SIZE - HEADER_SIZE
+CHECKSUM_SIZE = 32  # SHA-256, protects the session start packet
+HEADER_SIZE = SESSION_ID_SIZE + SEQUENCE_NUM_SIZE + CHECKSUM_SIZE
 BYTE_ORDER = 'big'
 TIMEOUT = 1  # seconds
-WINDOW_SIZE = 10  # Size of the receiving window
+RECV_WINDOW = 4096  # Segments past the cumulative ACK a sender may have outstanding
+ACK_EVERY = 4  # In-order segments answered by one ACK
+ACK_DELAY = 0.002  # seconds an ACK may wait for more segments, well under the sender's minimum RTO
+WINDOW_SIZE_SIZE = 4
+SESSION_TIMEOUT = 30  # seconds of silence before a session is dropped
+MAX_SESSIONS = 64  # Concurrent transfers accepted at once
+MAX_AUTO_BUFFER = 8 * 1024 * 1024  # Ceiling for the auto-sized receive buffer, in bytes
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)  # Linux, exceeds net.core.wmem_max with CAP_NET_ADMIN
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)  # Linux UDP GRO, not exported by every Python build
+GRO_BUFFER_SIZE = 65535  # One coalesced read can carry up to 64 KiB of datagrams
+RING_BYTES = 8 * 1024 * 1024  # Receive ring between the socket thread and the protocol thread, in bytes
+VERIFY_BATCH = 16  # Ring slots taken off the queue and verified together
+WRITE_BATCH = 256 * 1024  # Contiguous bytes of a session gathered into one vectored write
+WRITE_BUFFERS = 512  # Segments in one vectored write, under IOV_MAX
+ID_STRUCT = struct.Struct(f'!{SESSION_ID_SIZE}sI')  # Session id and sequence number at the front of every packet
+PROTOCOL_VERSION = 3  # Handshakes carrying any other version are refused
+HANDSHAKE_SEQ_NUM = 0xFFFFFFFC  # Sequence number of the handshake and its reply, never a data segment or an ACK
+PROBE_SEQ_NUM = 0xFFFFFFFB  # Sequence number of a path MTU probe, echoed with its size outside any session
+# Sequence number of the whole-file check after a multi-stream transfer, outside any session: the file's digest
+# and name, answered with the sequence number and 1 if the file on disk hashes the same
+VERIFY_SEQ_NUM = 0xFFFFFFFA
+# Version, checksum proposal, flags, file size, the byte range this session carries, the FEC group size, packet
+# size and window, ahead of the file name in the handshake
+START_STRUCT = struct.Struct('!BBBQQQBHI')
+# Handshake sequence number, version, then the checksum, packet size and receive window taken and the longest
+# an ACK may be held back, in microseconds
+HANDSHAKE_REPLY = struct.Struct('!IBBHII')
+START_FLAG_RESUME = 0x01  # Keep the existing file and only take blocks that differ
+START_FLAG_BATCH = 0x02  # The range is several files back to back, laid out by a listing sent before any data
+FEC_SEQ_FLAG = 0x80000000  # Marks an XOR parity packet, the rest of the sequence number is its group
+MANIFEST_SEQ_NUM = 0xFFFFFFFE  # Sequence number of a block-hash manifest page, answered with a match bitmap
+LISTING_SEQ_NUM = 0xFFFFFFFD  # Sequence number of a batch listing page, answered with its index and a status
+LISTING_ENTRY = struct.Struct('!QH')  # File size and path length, ahead of the relative path in a listing page
+OPEN_FILES = 64  # Files a batch session keeps open at once
+BLOCK_SEGMENTS = 512  # Segments per manifest block
+BLOCK_HASH_SIZE = 8
+DIGEST_SIZE = 32  # SHA-256 of the session's byte range, carried by the EOF packet
+STATS_REQUEST = b'STAT'  # Datagram asking for the server's statistics, answered with JSON if enabled
+
+class Session:
+    """Receive state of one transfer, keyed by client address and session id."""
+
+    def __init__(self, address, session_id: int, file_name: str, file_size: int, offset: int, length: int,
+                 checksum_id: int, flags: int, fec_group: int, start_packet: bytes, recv_window: int,
+                 packet_size: int):
+        self.address = address
+        self.session_id = session_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.offset = offset  # Byte range of the file carried by this session, all of it unless multi-stream
+        self.length = length
+        self.checksum_id = checksum_id
+        _, checksum_size, self.checksum = CHECKSUMS[checksum_id]
+        self.checksum_size = checksum_size
+        self.header_size = SESSION_ID_SIZE + SEQUENCE_NUM_SIZE + checksum_size
+        self.packet_size = packet_size
+        self.payload_size = packet_size - self.header_size
+        self.segment_count = (length + self.payload_size - 1) // self.payload_size
+        self.start_packet = start_packet  # Duplicates of it are re-ACKed, not taken as data
+        # The SACK bitmap of an ACK has to fit in one packet along with its checksum and fixed fields
+        self.recv_window = min(recv_window, (packet_size - checksum_size - SEQUENCE_NUM_SIZE - WINDOW_SIZE_SIZE) * 8)
+        self.flags = flags
+        # Segments are written straight to their offset, so out-of-order data costs one bit instead of a buffer.
+        # The range maps onto files as (range start, length, path, file offset), one entry unless it is a batch.
+        self.files = None
+        self.starts = []  # Range start of each file, for bisect
+        self.fds = OrderedDict()  # Index into files -> open descriptor, least recently used first
+        self.listing = {}  # Batch listing pages by index until all have arrived
+        self.refused = False  # The batch listing named a path outside the working directory
+        if not flags & START_FLAG_BATCH:
+            # Sessions carrying one range of a multi-stream transfer share the file and must not truncate it,
+            # neither may a resumed session, whose blocks are compared against the existing content
+            truncate = offset == 0 and length == file_size and not flags & START_FLAG_RESUME
+            self.files = [(0, length, file_name, offset)]
+            self.starts = [0]
+            self.fds[0] = self.create(file_name, file_size, truncate)
+        self.received = bytearray(self.segment_count // 8 + 1)  # Bit per segment, set once written
+        self.expected_seq_num = 0
+        self.eof_seq_num = None
+        self.manifest_replies = {}  # First block of a manifest page -> reply, so resent pages are not re-hashed
+        self.fec_group = fec_group  # Data segments covered by each parity packet, 0 without FEC
+        self.parity = {}  # Group -> parity payload, kept until the group is complete or rebuilt
+        self.digest = hashlib.sha256()  # Of the range, fed in order as the cumulative ACK point advances
+        self.digested = 0  # Segments hashed so far
+        self.verified = None  # Whether the sender's digest matched, once EOF arrived
+        self.unacked = 0  # In-order segments taken since the last ACK
+        self.run = []  # Contiguous segments not written yet, from range position run_start to run_end
+        self.run_start = self.run_end = 0
+        self.ack_deadline = None  # When a held-back ACK has to go out
+        self.stats = Stats(quiet=True)  # This transfer alone, dumped when it ends
+        self.start_time = self.last_active = time.time()
+
+    @staticmethod
+    def create(path: str, size: int, truncate: bool):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | (os.O_TRUNC if truncate else 0), 0o644)
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            pass  # No fallocate on this platform or filesystem, or nothing to allocate
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+        return fd
+
+    def add_listing_page(self, payload):
+        # Page = index, page count, then entries. Once every page is in, the files are created in order and the
+        # range is laid out over them, an empty file taking no bytes of it.
+        index = int.from_bytes(payload[:SEQUENCE_NUM_SIZE], BYTE_ORDER)
+        count = int.from_bytes(payload[SEQUENCE_NUM_SIZE:2 * SEQUENCE_NUM_SIZE], BYTE_ORDER)
+        if index < count:
+            self.listing.setdefault(index, bytes(payload[2 * SEQUENCE_NUM_SIZE:]))
+        if len(self.listing) < count:
+            return
+        entries = b''.join(self.listing[i] for i in range(count))
+        self.listing = None
+        files = []
+        paths = set()
+        pos = start = 0
+        while pos < len(entries):
+            size, name_length = LISTING_ENTRY.unpack_from(entries, pos)
+            pos += LISTING_ENTRY.size
+            path = local_path(entries[pos:pos + name_length].decode("utf-8"))
+            pos += name_length
+            if path is None or path in paths:
+                self.refused = True  # Outside the working directory, or a path already listed
+                return
+            paths.add(path)
+            files.append((start, size, path, 0))
+            start += size
+        if start != self.length:
+            self.refused = True
+            return
+        try:
+            for _, size, path, _ in files:
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.close(self.create(path, size, not self.flags & START_FLAG_RESUME))
+        except OSError:
+            self.refused = True  # A listed directory is a file here, or the disk or permissions say no
+            return
+        self.files = files
+        self.starts = [start for start, _, _, _ in files]
+
+    def open_file(self, index: int):
+        fd = self.fds.pop(index, None)
+        if fd is None:
+            if len(self.fds) >= OPEN_FILES:
+                os.close(self.fds.popitem(last=False)[1])
+            fd = os.open(self.files[index][2], os.O_RDWR)
+        self.fds[index] = fd
+        return fd
+
+    def extents(self, pos: int, size: int):
+        # (descriptor, file position, length) of each piece of the size bytes of the range from pos
+        index = bisect.bisect_right(self.starts, pos) - 1
+        while size > 0 and index < len(self.files):
+            start, length, _, file_offset = self.files[index]
+            n = min(size, start + length - pos)
+            if n > 0:
+                yield self.open_file(index), file_offset + pos - start, n
+                pos += n
+                size -= n
+            index += 1
+
+    def pwrite(self, buffers, pos: int):
+        # Buffers back to back from pos. A run within one file goes out in one vectored write, one crossing
+        # files in a batch is joined and split at their edges.
+        size = sum(map(len, buffers))
+        index = bisect.bisect_right(self.starts, pos) - 1
+        start, length, _, file_offset = self.files[index]
+        if pos + size <= start + length and hasattr(os, 'pwritev'):
+            os.pwritev(self.open_file(index), buffers, file_offset + pos - start)
+            return
+        data = b''.join(buffers)
+        done = 0
+        for fd, file_pos, n in self.extents(pos, size):
+            os.pwrite(fd, data[done:done + n], file_pos)
+            done += n
+
+    def pread(self, size: int, pos: int):
+        self.flush()  # What is read back may still be in the gathered run
+        return b''.join(os.pread(fd, n, file_pos) for fd, file_pos, n in self.extents(pos, size))
+
+    def flush(self):
+        if self.run:
+            run, self.run = self.run, []
+            self.pwrite(run, self.run_start)
+
+    def close(self):
+        self.flush()
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+    def has(self, seq_num: int):
+        return self.received[seq_num >> 3] >> (seq_num & 7) & 1
+
+    def write(self, seq_num: int, payload):
+        # Segments that continue the current run are gathered, anything else writes the run out first. The
+        # payload is copied since the ring slot it lives in is reused once the datagram is handled.
+        pos = seq_num * self.payload_size
+        if self.run and pos != self.run_end:
+            self.flush()
+        if not self.run:
+            self.run_start = pos
+        self.run.append(bytes(payload))
+        self.run_end = pos + len(payload)
+        self.mark_received(seq_num, seq_num + 1)
+        self.update_digest(seq_num, payload)
+        if self.run_end - self.run_start >= WRITE_BATCH or len(self.run) >= WRITE_BUFFERS:
+            self.flush()
+
+    def update_digest(self, seq_num: int = None, payload=None):
+        # Hash the in-order part of the range as it grows. The segment just written is hashed from the packet,
+        # segments that arrived ahead of it or were kept by a resume are read back while still in the page cache.
+        while self.digested < self.expected_seq_num:
+            if self.digested == seq_num:
+                self.digest.update(payload)
+            else:
+                self.digest.update(self.pread(self.segment_size(self.digested), self.digested * self.payload_size))
+            self.digested += 1
+
+    def mark_received(self, first: int, end: int):
+        for seq_num in range(first, end):
+            self.received[seq_num >> 3] |= 1 << (seq_num & 7)
+        while self.expected_seq_num < self.segment_count and self.has(self.expected_seq_num):
+            self.expected_seq_num += 1
+
+    def segment_size(self, seq_num: int):
+        return min(self.payload_size, self.length - seq_num * self.payload_size)
+
+    def recover(self, group: int):
+        # XOR of the parity and every other segment of the group rebuilds the one segment still missing.
+        # The others are already on disk, so they are read back rather than kept in memory.
+        first = group * self.fec_group
+        end = min(first + self.fec_group, self.segment_count)
+        missing = [seq_num for seq_num in range(first, end) if not self.has(seq_num)]
+        if len(missing) > 1:
+            return False
+        parity = self.parity.pop(group)
+        if not missing:
+            return False
+        value = int.from_bytes(parity, 'little')
+        for seq_num in range(first, end):
+            if seq_num != missing[0]:
+                value ^= int.from_bytes(self.pread(self.segment_size(seq_num), seq_num * self.payload_size), 'little')
+        self.write(missing[0], value.to_bytes(self.payload_size, 'little')[:self.segment_size(missing[0])])
+        return True
+
+    def compare_manifest(self, payload):
+        # Hash our copy of each block listed in the page, blocks that match the sender's hash count as received
+        first_block = int.from_bytes(payload[:SEQUENCE_NUM_SIZE], BYTE_ORDER)
+        block_bytes = BLOCK_SEGMENTS * self.payload_size
+        matched = 0
+        for i in range((len(payload) - SEQUENCE_NUM_SIZE) // BLOCK_HASH_SIZE):
+            start = (first_block + i) * block_bytes
+            if start >= self.length:
+                break
+            ours = self.pread(min(block_bytes, self.length - start), start)
+            theirs = payload[SEQUENCE_NUM_SIZE + i * BLOCK_HASH_SIZE:SEQUENCE_NUM_SIZE + (i + 1) * BLOCK_HASH_SIZE]
+            if hashlib.blake2b(ours, digest_size=BLOCK_HASH_SIZE).digest() == theirs:
+                matched |= 1 << i
+                first = (first_block + i) * BLOCK_SEGMENTS
+                self.mark_received(first, min(first + BLOCK_SEGMENTS, self.segment_count))
+        return (MANIFEST_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + payload[:SEQUENCE_NUM_SIZE]
+                + matched.to_bytes((matched.bit_length() + 7) // 8, 'little'))
+
+    def seal(self, body: bytes):
+        # Replies lead with the session checksum of the rest, so the sender can drop damaged ones
+        return self.checksum(body) + body
+
+    def build_ack(self):
+        # Signed cumulative ACK, the advertised window, then a bitmap where bit i marks segment
+        # expected_seq_num + 1 + i as already written
+        first = self.expected_seq_num + 1
+        span = self.recv_window
+        bitmap = int.from_bytes(self.received[first >> 3:((first + span) >> 3) + 1], 'little') >> (first & 7)
+        bitmap &= (1 << span) - 1
+        sack = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+        return ((self.expected_seq_num - 1).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER, signed=True)
+                + self.recv_window.to_bytes(WINDOW_SIZE_SIZE, BYTE_ORDER) + sack)
+
+def local_path(name: str):
+    # Relative '/'-separated path from a batch listing or a handshake as a path under the working directory,
+    # None if it is absolute or would climb out of it
+    parts = name.split('/')
+    if any(part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part) for part in parts):
+        return None
+    return os.path.join(*parts)
 
 class Server:
-    def __init__(self, server_ip, server_port: int):
+    def __init__(self, server_ip, server_port: int, max_sessions: int = MAX_SESSIONS,
+                 recv_window: int = RECV_WINDOW, reuse_port: bool = False, debug: bool = False,
+                 stats_file: str = None, sndbuf: int = 0, rcvbuf: int = 0, ack_every: int = ACK_EVERY,
+                 ack_delay: float = ACK_DELAY, verify_threads: int = 0, stats_endpoint: bool = False):
         self.server_ip = server_ip
         self.server_port = server_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            # Worker processes share the port, the kernel keeps each client socket on one worker
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.server_ip, self.server_port))
-        self.buffer = {}  # Buffer to store out-of-order packets
+        self.server_socket.settimeout(TIMEOUT)  # The receive thread wakes up to notice the server closing
+        try:
+            # Let the kernel hand over runs of same-flow datagrams in one read
+            self.server_socket.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+            self.gro = True
+        except (AttributeError, OSError):
+            self.gro = False
+        # The receive thread reads datagrams into free slots of this ring and queues them, the protocol thread
+        # handles them through views of the slot and hands it back. Nothing is copied before verification, and a
+        # slow disk or a burst of hashing backs datagrams up in the ring rather than in the socket buffer.
+        slot_size = GRO_BUFFER_SIZE if self.gro else MAX_PACKET_SIZE
+        self.ring = [memoryview(bytearray(slot_size)) for _ in range(max(RING_BYTES // slot_size, VERIFY_BATCH))]
+        self.free_slots = queue.SimpleQueue()
+        for index in range(len(self.ring)):
+            self.free_slots.put(index)
+        self.ready = queue.SimpleQueue()  # (slot, bytes read, GRO segment size, client address)
+        self.stopping = threading.Event()
+        # Checksums are computed in this pool ahead of the protocol thread, hashlib and zlib let go of the GIL
+        # for large inputs
+        self.verify_pool = ThreadPoolExecutor(verify_threads) if verify_threads > 0 else None
+        self.max_sessions = max_sessions
+        self.recv_window = recv_window
+        self.ack_every = max(ack_every, 1)
+        self.ack_delay = ack_delay
+        # A sender may have a full receive window in flight, which is the most the path's bandwidth-delay product
+        # can usefully be, so by default the receive buffer is sized to absorb one without drops. It grows when a
+        # client's probed packet size makes that window larger in bytes.
+        self.auto_rcvbuf = 0 if rcvbuf else min(self.recv_window * TOTAL_PACKET_SIZE, MAX_AUTO_BUFFER)
+        self.rcvbuf = set_buffer(self.server_socket, socket.SO_RCVBUF, SO_RCVBUFFORCE, rcvbuf or self.auto_rcvbuf)
+        self.sndbuf = set_buffer(self.server_socket, socket.SO_SNDBUF, SO_SNDBUFFORCE, sndbuf) if sndbuf \
+            else self.server_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        self.sessions = {}  # (client address, session id) -> Session
+        self.stats = Stats(debug)
+        self.stats_file = stats_file  # Where a JSON record of every finished transfer is appended, if anywhere
+        self.stats_endpoint = stats_endpoint  # Whether STAT datagrams are answered
 
     def receive(self):
-        while True:
+        receiver = threading.Thread(target=self.receive_datagrams, daemon=True)
+        receiver.start()
+        try:
+            while True:
+                # Wake up for the earliest held-back ACK as well as for datagrams
+                deadline = min((session.ack_deadline for session in self.sessions.values()
+                                if session.ack_deadline is not None), default=None)
+                timeout = TIMEOUT if deadline is None else min(max(deadline - time.time(), 0), TIMEOUT)
+                batch = []
+                try:
+                    batch.append(self.ready.get(timeout=timeout))
+                    while len(batch) < VERIFY_BATCH:
+                        batch.append(self.ready.get_nowait())
+                except queue.Empty:
+                    pass
+                if batch:
+                    self.handle_slots(batch)
+                else:
+                    # Quiet for a moment, write out what was gathered instead of waiting for a full run
+                    for session in self.sessions.values():
+                        try:
+                            session.flush()
+                        except OSError as e:
+                            print(f"Error: {e}")
+                self.flush_acks()
+                if any(session.eof_seq_num is None for session in self.sessions.values()):
+                    self.stats.tick(self.stats.counters['bytes_received'])
+                for session in self.sessions.values():
+                    if session.eof_seq_num is None:
+                        session.stats.tick(session.stats.counters['bytes_received'])
+                self.expire_sessions()
+        except KeyboardInterrupt:
+            print("Server closed.")
+        finally:
+            self.stopping.set()
+            receiver.join()
+            if self.verify_pool:
+                self.verify_pool.shutdown()
+            for session in self.sessions.values():
+                self.close_session(session)
+            self.server_socket.close()
+
+    def receive_datagrams(self):
+        # Socket stage, on its own thread: one socket serves all sessions, read it into the ring as fast as the
+        # kernel hands datagrams over
+        while not self.stopping.is_set():
+            if self.free_slots.empty():
+                self.stats.counters['ring_full'] += 1
             try:
-                # First, receive the file name
-                filename_received = False
-                expected_seq_num = 0
-                file_name = None
-                client_address = None
-                
-                while not filename_received:
-                    data, client_address = self.server_socket.recvfrom(TOTAL_PACKET_SIZE)
-                    
-                    if len(data) < HEADER_SIZE:
-                        print("Received incomplete packet, ignoring...")
-                        continue
-                    
-                    # Extract header
-                    header = data[:HEADER_SIZE]
-                    sequence_number = int.from_bytes(header[:SEQUENCE_NUM_SIZE], BYTE_ORDER)
-                    received_checksum = header[SEQUENCE_NUM_SIZE:]
-                    
-                    payload = data[HEADER_SIZE:]
-                    calculated_checksum = hashlib.sha256(payload).digest()
-                    
-                    if received_checksum == calculated_checksum:
-                        if sequence_number == 0:  # First packet contains filename
-                            file_name = payload.decode("utf-8")
-                            print(f"Receiving file name: {file_name}")
-                            expected_seq_num = 0
-                            filename_received = True
-                            
-                            # Send ACK for filename packet
-                            self.server_socket.sendto((0).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), client_address)
-                        else:
-                            print(f"Expected sequence 0 for filename, got {sequence_number}, sending ACK 0")
-                            self.server_socket.sendto((0).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), client_address)
-                    else:
-                        print("Checksum mismatch for filename packet, ignoring...")
-                        
-                
-                # Now receive the file content with pipelining
-                with open(file_name, 'wb') as file:
-                    eof_received = False
-                    
-                    while not eof_received:
-                        data, addr = self.server_socket.recvfrom(TOTAL_PACKET_SIZE)
-                        
-                        if len(data) < HEADER_SIZE:
-                            print("Received an incomplete packet, ignoring...")
-                            continue
-                        
-                        # Extract header
-                        header = data[:HEADER_SIZE]
-                        sequence_number = int.from_bytes(header[:SEQUENCE_NUM_SIZE], BYTE_ORDER)
-                        received_checksum = header[SEQUENCE_NUM_SIZE:]
-                        
-                        payload = data[HEADER_SIZE:]
-                        calculated_checksum = hashlib.sha256(payload).digest()
-                            
-                        
-                        # Check if valid packet
-                        if received_checksum == calculated_checksum:
-                            # Check if it's EOF
-                            if len(payload) == 0:
-                                self.server_socket.sendto(sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), addr)
-                                eof_received = True
-                                continue
-                            
-                            # Store valid packets in buffer
-                            if sequence_number >= expected_seq_num:
-                                self.buffer[sequence_number] = payload
-                            else:
-                                print(f"Duplicate packet {sequence_number}, already processed")
-                            
-                            # Process in-order packets from buffer
-                            while expected_seq_num in self.buffer:
-                                file.write(self.buffer[expected_seq_num])
-                                del self.buffer[expected_seq_num]
-                                expected_seq_num += 1
-                            
-                            # Send cumulative ACK for highest in-order packet received
-                            ack_num = expected_seq_num - 1
-                            self.server_socket.sendto(ack_num.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), addr)
-                        else:
-                            print(f"Checksum mismatch for segment {sequence_number}, ignoring...")
-                            # Resend ACK for last correctly received packet
-                            ack_num = expected_seq_num - 1
-                            if ack_num >= 0:  # Only send ACK if at least one packet was received
-                                self.server_socket.sendto(ack_num.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), addr)
-                                print(f"Resent ACK {ack_num} after checksum failure")
-                
-                print(f"File {file_name} received successfully.")
-                print(hashlib.sha256(open(file_name, 'rb').read()).hexdigest())
-                self.buffer.clear()  # Clear buffer for next file
-                return 0
-
-            except Exception as e:
-                print(f"Error: {e}")
-            except KeyboardInterrupt:
-                print("Server closed.")
-                self.server_socket.close()
-                break
+                index = self.free_slots.get(timeout=TIMEOUT)
+            except queue.Empty:
+                continue
+            try:
+                nbytes, ancdata, _, client_address = self.server_socket.recvmsg_into(
+                    [self.ring[index]], socket.CMSG_SPACE(4))
+            except socket.timeout:
+                self.free_slots.put(index)
+                continue
+            # A GRO read holds several datagrams back to back, all but the last exactly segment_size long
+            segment_size = nbytes or 1
+            for level, kind, value in ancdata:
+                if level == socket.SOL_UDP and kind == UDP_GRO:
+                    segment_size = struct.unpack('=i', value[:4])[0]
+            self.ready.put((index, nbytes, segment_size, client_address))
 
-def main():
-    if len(sys.argv) < 3:
-        print(f"Usage: {sys.argv[0]} <server_ip> <server_port>")
-        sys.exit(1)
+    def datagrams(self, index: int, nbytes: int, segment_size: int):
+        slot = self.ring[index]
+        for offset in range(0, max(nbytes, 1), segment_size):
+            yield slot[offset:min(offset + segment_size, nbytes)]
+
+    def verify_slot(self, index: int, nbytes: int, segment_size: int, client_address):
+        # Verification stage: whether each datagram of a slot carries a good checksum, None where the protocol
+        # thread has to decide (no session yet, a handshake or probe, a runt)
+        verdicts = []
+        for data in self.datagrams(index, nbytes, segment_size):
+            verdict = None
+            if len(data) >= ID_STRUCT.size:
+                session_key, sequence_number = ID_STRUCT.unpack_from(data)
+                session = self.sessions.get((client_address, int.from_bytes(session_key, BYTE_ORDER)))
+                if session is not None and sequence_number not in (HANDSHAKE_SEQ_NUM, PROBE_SEQ_NUM, VERIFY_SEQ_NUM) \
+                        and len(data) >= session.header_size:
+                    verdict = session.checksum(data[session.header_size:]) == data[ID_STRUCT.size:session.header_size]
+            verdicts.append(verdict)
+        return verdicts
 
-    server_ip = sys.argv[1]
-    server_port = int(sys.argv[2])
-    server = Server(server_ip, server_port)
+    def handle_slots(self, batch):
+        # The pool verifies the whole batch while the protocol thread works through it in arrival order, each
+        # slot going back to the receive thread once its datagrams are handled
+        verdicts = [self.verify_pool.submit(self.verify_slot, *item) for item in batch] if self.verify_pool else None
+        for i, (index, nbytes, segment_size, client_address) in enumerate(batch):
+            checks = verdicts[i].result() if verdicts else None
+            for j, data in enumerate(self.datagrams(index, nbytes, segment_size)):
+                try:
+                    self.handle_packet(data, client_address, checks[j] if checks else None)
+                except Exception as e:
+                    print(f"Error: {e}")
+            self.free_slots.put(index)
 
-    print(f"Server is listening on {server_ip}:{server_port}")
+    def send_ack(self, session: Session):
+        session.unacked = 0
+        session.ack_deadline = None
+        self.count(session, 'acks_sent')
+        self.server_socket.sendto(session.seal(session.build_ack()), session.address)
+
+    def flush_acks(self):
+        now = time.time()
+        for session in self.sessions.values():
+            if session.ack_deadline is not None and session.ack_deadline <= now:
+                self.send_ack(session)
+
+    def count(self, session: Session, name: str, n: int = 1):
+        # Server-wide for the STAT endpoint, and the session's own for its record
+        self.stats.counters[name] += n
+        session.stats.counters[name] += n
+
+    def expire_sessions(self):
+        now = time.time()
+        for key, session in list(self.sessions.items()):
+            if now - session.last_active > SESSION_TIMEOUT:
+                if session.eof_seq_num is None:
+                    print(f"Session {session.session_id:08x} from {session.address} timed out, dropping {session.file_name}")
+                self.close_session(session)
+                del self.sessions[key]
+
+    def close_session(self, session: Session):
+        session.close()
+
+    def handle_packet(self, data: memoryview, client_address, checksum_ok: bool = None):
+        if data == STATS_REQUEST and self.stats_endpoint:
+            self.send_stats(client_address)
+            return
+        if len(data) < SESSION_ID_SIZE + SEQUENCE_NUM_SIZE:
+            self.stats.counters['incomplete'] += 1
+            if self.stats.debug:
+                print("Received an incomplete packet, ignoring...")
+            return
+        session_key, sequence_number = ID_STRUCT.unpack_from(data)
+        if sequence_number == PROBE_SEQ_NUM:
+            # Path MTU probe, its size tells the client this much gets through
+            self.stats.counters['probes'] += 1
+            self.server_socket.sendto(PROBE_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                                      + len(data).to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER), client_address)
+            return
+        if sequence_number == VERIFY_SEQ_NUM:
+            self.verify_file(data, client_address)
+            return
+        session_id = int.from_bytes(session_key, BYTE_ORDER)
+        session = self.sessions.get((client_address, session_id))
+        if session is None or sequence_number == HANDSHAKE_SEQ_NUM:
+            self.start_session(data, client_address, session_id, sequence_number, session)
+            return
+        session.last_active = time.time()
+        self.count(session, 'packets_received')
+
+        if len(data) < session.header_size:
+            self.count(session, 'incomplete')
+            if self.stats.debug:
+                print("Received an incomplete packet, ignoring...")
+            return
+
+        # Extract header
+        received_checksum = data[ID_STRUCT.size:session.header_size]
+        payload = data[session.header_size:]
+        if checksum_ok is None:
+            checksum_ok = session.checksum(payload) == received_checksum
+
+        # Check if valid packet
+        if not checksum_ok:
+            self.count(session, 'checksum_failures')
+            if self.stats.debug:
+                print(f"Checksum mismatch for segment {sequence_number}, ignoring...")
+            # Resend ACK for last correctly received packet
+            self.send_ack(session)
+            return
+        if len(payload) > session.payload_size:
+            # Sent ahead of the handshake reply under a larger packet size than the one granted
+            self.count(session, 'oversized')
+            return
+
+        if sequence_number == LISTING_SEQ_NUM:
+            if session.files is None and not session.refused:
+                session.add_listing_page(payload)
+                if session.refused:
+                    print(f"Refusing batch from {client_address}: listing names a path outside the working "
+                          f"directory or twice, does not add up to {session.length} bytes, or its files cannot "
+                          f"be created")
+            self.server_socket.sendto(session.seal(LISTING_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                                                   + bytes(payload[:SEQUENCE_NUM_SIZE]) + bytes([not session.refused])),
+                                      client_address)
+            return
+        if session.files is None:
+            return  # Batch listing still incomplete, nothing can be placed yet
+
+        if sequence_number == MANIFEST_SEQ_NUM:
+            first_block = bytes(payload[:SEQUENCE_NUM_SIZE])
+            if first_block not in session.manifest_replies:
+                session.manifest_replies[first_block] = session.seal(session.compare_manifest(payload))
+            self.server_socket.sendto(session.manifest_replies[first_block], client_address)
+            return
+
+        # Check if it's EOF, numbered one past the last segment and carrying the sender's digest of the range
+        if sequence_number == session.segment_count and len(payload) == DIGEST_SIZE:
+            if session.eof_seq_num is None:
+                session.eof_seq_num = sequence_number
+                session.update_digest()
+                session.verified = session.digested == session.segment_count and session.digest.digest() == payload
+                self.close_session(session)
+                if not session.verified:
+                    print(f"{session.file_name} does NOT match the sender's digest.")
+                elif session.flags & START_FLAG_BATCH:
+                    print(f"Batch of {len(session.files)} files ({session.length} bytes) received and verified.")
+                    print(session.digest.hexdigest())
+                elif session.length == session.file_size:
+                    print(f"File {session.file_name} received and verified successfully.")
+                    print(session.digest.hexdigest())
+                else:
+                    print(f"Bytes {session.offset}-{session.offset + session.length} of {session.file_name} received "
+                          f"and verified.")
+                elapsed = time.time() - session.start_time
+                print(f"Took {elapsed:.2f} seconds, {session.length * 8 / max(elapsed, 1e-6) / 1e6:.2f} Mbit/s")
+                if self.stats_file:
+                    session.stats.dump(self.stats_file, file=session.file_name, session=f"{session.session_id:08x}",
+                                       offset=session.offset, length=session.length,
+                                       transfer_elapsed=round(elapsed, 3), verified=session.verified)
+            # Re-ACKed with the verdict for as long as the finished session is remembered
+            self.server_socket.sendto(session.seal(sequence_number.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER)
+                                                   + bytes([session.verified])), client_address)
+            return
+        if session.eof_seq_num is not None:
+            return  # Straggler from a finished transfer
+
+        if sequence_number & FEC_SEQ_FLAG:
+            group = sequence_number & ~FEC_SEQ_FLAG
+            if session.fec_group and group * session.fec_group < session.segment_count \
+                    and len(payload) == session.payload_size and group not in session.parity:
+                session.parity[group] = bytes(payload)
+                if session.recover(group):
+                    # A rebuilt segment fills a hole the sender is about to retransmit, tell it at once
+                    self.count(session, 'fec_recovered')
+                    self.send_ack(session)
+            return
+
+        # Steady in-order data is ACKed every ack_every segments or after ack_delay. Anything the sender should
+        # react to is ACKed at once: a segment past a hole, one that fills a hole, a duplicate (our ACK may have
+        # been lost), a rebuilt segment and the end of the range.
+        immediate = True
+        if sequence_number >= session.segment_count or sequence_number >= session.expected_seq_num + session.recv_window:
+            self.count(session, 'outside_window')
+            if self.stats.debug:
+                print(f"Segment {sequence_number} outside the receive window, dropping")
+        elif session.has(sequence_number):
+            self.count(session, 'duplicates')
+            if self.stats.debug:
+                print(f"Duplicate packet {sequence_number}, already processed")
+        else:
+            in_order = sequence_number == session.expected_seq_num
+            if not in_order:
+                self.count(session, 'out_of_order')
+            session.write(sequence_number, payload)
+            self.count(session, 'bytes_received', len(payload))
+            immediate = not in_order or session.expected_seq_num != sequence_number + 1 \
+                or session.expected_seq_num == session.segment_count
+            if session.fec_group and sequence_number // session.fec_group in session.parity \
+                    and session.recover(sequence_number // session.fec_group):
+                self.count(session, 'fec_recovered')
+                immediate = True
+            if self.stats.debug:
+                print(f"Received segment {sequence_number} ({len(payload)} bytes).")
+
+        # Cumulative ACK for the highest in-order packet received, with SACK for the rest
+        session.unacked += 1
+        if immediate or session.unacked >= self.ack_every:
+            self.send_ack(session)
+        elif session.ack_deadline is None:
+            session.ack_deadline = time.time() + self.ack_delay
+
+    def start_session(self, data, client_address, session_id: int, sequence_number: int, session):
+        if len(data) < HEADER_SIZE:
+            self.stats.counters['incomplete'] += 1
+            if self.stats.debug:
+                print("Received an incomplete packet, ignoring...")
+            return
+
+        # Extract header
+        received_checksum = data[ID_STRUCT.size:HEADER_SIZE]
+        
+        payload = data[HEADER_SIZE:]
+        calculated_checksum = hashlib.sha256(payload).digest()
+
+        if received_checksum != calculated_checksum or sequence_number != HANDSHAKE_SEQ_NUM \
+                or len(payload) <= START_STRUCT.size:
+            if session is None:
+                # Normal after a lost or overtaken handshake (data follows it without waiting) or an expired session
+                self.stats.counters['unknown_session'] += 1
+                if self.stats.debug:
+                    print(f"Packet for unknown session {session_id:08x} from {client_address}, ignoring...")
+            return
+        if session is not None and data != session.start_packet:
+            return  # Another handshake under an id already in use
+
+        if session is None:
+            # Handshake: version, checksum proposal, flags, file size, byte range, FEC group, packet size, window
+            # and the file name
+            version, checksum_id, flags, file_size, offset, length, fec_group, packet_size, window = \
+                START_STRUCT.unpack_from(payload)
+            if version != PROTOCOL_VERSION:
+                print(f"Unsupported protocol version {version} from {client_address}, ignoring...")
+                return
+            active = sum(1 for other in self.sessions.values() if other.eof_seq_num is None)
+            if active >= self.max_sessions:
+                print(f"Session limit reached, refusing {client_address}")
+                return
+            # Accept the client's checksum proposal if we know it, fall back to SHA-256 otherwise, and its packet
+            # size within what we are prepared to receive
+            if checksum_id not in CHECKSUMS:
+                checksum_id = CHECKSUM_SHA256
+            packet_size = min(max(packet_size, MIN_PACKET_SIZE), MAX_PACKET_SIZE)
+            file_name = bytes(payload[START_STRUCT.size:]).decode("utf-8")
+            if not flags & START_FLAG_BATCH:
+                # The name is opened in place, possibly without truncation, so it has to stay in the working
+                # directory like the paths of a batch listing
+                file_name = local_path(file_name)
+                if file_name is None:
+                    print(f"Refusing {client_address}: file name is absolute or outside the working directory")
+                    return
+            session = Session(client_address, session_id, file_name, file_size, offset, length, checksum_id, flags,
+                              fec_group, bytes(data), min(self.recv_window, window), packet_size)
+            self.sessions[(client_address, session_id)] = session
+            if self.auto_rcvbuf and session.recv_window * packet_size > self.auto_rcvbuf:
+                self.auto_rcvbuf = min(session.recv_window * packet_size, MAX_AUTO_BUFFER)
+                self.rcvbuf = set_buffer(self.server_socket, socket.SO_RCVBUF, SO_RCVBUFFORCE, self.auto_rcvbuf)
+            print(f"Receiving {'batch' if flags & START_FLAG_BATCH else 'file name'}: {session.file_name} "
+                  f"({file_size} bytes, {CHECKSUMS[checksum_id][0]} checksum, {packet_size}-byte packets) "
+                  f"from {client_address}, session {session_id:08x}")
+        session.last_active = time.time()
+
+        # Reply with the settings taken, under SHA-256 like the handshake since the client may not know the
+        # checksum yet
+        reply = HANDSHAKE_REPLY.pack(HANDSHAKE_SEQ_NUM, PROTOCOL_VERSION, session.checksum_id, session.packet_size,
+                                     session.recv_window, round(self.ack_delay * 1e6))
+        self.server_socket.sendto(hashlib.sha256(reply).digest() + reply, client_address)
+
+    def verify_file(self, data, client_address):
+        # Whole-file check once every range of a multi-stream transfer has had its EOF answered. By then each
+        # range session is closed and its writes flushed, whichever worker process held it, so the file on disk
+        # is what the ranges reassembled into. Protected by SHA-256 like the handshake, and so is the answer.
+        payload = data[HEADER_SIZE:]
+        if len(payload) <= DIGEST_SIZE or data[ID_STRUCT.size:HEADER_SIZE] != hashlib.sha256(payload).digest():
+            return
+        file_name = local_path(bytes(payload[DIGEST_SIZE:]).decode("utf-8"))
+        digest = None
+        if file_name is not None:
+            try:
+                digest = file_digest(file_name)
+            except OSError:
+                pass
+        matched = digest is not None and digest == payload[:DIGEST_SIZE]
+        if matched:
+            print(f"File {file_name} reassembled and verified successfully.")
+            print(digest.hex())
+        else:
+            print(f"File {file_name} does NOT match the sender's whole-file digest.")
+        reply = VERIFY_SEQ_NUM.to_bytes(SEQUENCE_NUM_SIZE, BYTE_ORDER) + bytes([matched])
+        self.server_socket.sendto(hashlib.sha256(reply).digest() + reply, client_address)
+
+    def send_stats(self, client_address):
+        # Pull endpoint on the transfer port itself, answered by whichever worker the query reaches
+        snapshot = dict(self.stats.as_dict(), pid=os.getpid(),
+                        active_sessions=sum(1 for session in self.sessions.values() if session.eof_seq_num is None))
+        self.server_socket.sendto(json.dumps(snapshot).encode("utf-8"), client_address)
+
+def serve(server_ip, server_port: int, max_sessions: int, recv_window: int, reuse_port: bool, debug: bool,
+          stats_file: str, sndbuf: int, rcvbuf: int, ack_every: int, ack_delay: float, verify_threads: int,
+          stats_endpoint: bool):
+    server = Server(server_ip, server_port, max_sessions, recv_window, reuse_port, debug, stats_file, sndbuf, rcvbuf,
+                    ack_every, ack_delay, verify_threads, stats_endpoint)
+    print(f"Server is listening on {server_ip}:{server_port} (receive buffer {server.rcvbuf} bytes, "
+          f"send buffer {server.sndbuf} bytes)")
     server.receive()
 
+def main():
+    parser = argparse.ArgumentParser(description="Receive files from URFT clients over a pipelined window.")
+    parser.add_argument('server_ip')
+    parser.add_argument('server_port', type=int)
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS,
+                        help=f"concurrent transfers accepted at once (default: {MAX_SESSIONS})")
+    parser.add_argument('--recv-window', type=int, default=RECV_WINDOW,
+                        help=f"segments a sender may have outstanding past the cumulative ACK (default: {RECV_WINDOW})")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="receive in this many processes sharing the port, for multi-stream clients (default: 1)")
+    parser.add_argument('--sndbuf', type=int, default=0, metavar='BYTES',
+                        help="socket send buffer size (default: 0, the kernel's)")
+    parser.add_argument('--rcvbuf', type=int, default=0, metavar='BYTES',
+                        help="socket receive buffer size (default: 0, room for one receive window)")
+    parser.add_argument('--ack-every', type=int, default=ACK_EVERY, metavar='N',
+                        help=f"in-order segments answered by one ACK (default: {ACK_EVERY}, 1 ACKs every segment)")
+    parser.add_argument('--ack-delay', type=float, default=ACK_DELAY * 1000, metavar='MS',
+                        help=f"longest an ACK waits for more segments (default: {ACK_DELAY * 1000:g} ms)")
+    parser.add_argument('--verify-threads', type=int, default=0, metavar='N',
+                        help="verify checksums in a pool of N threads ahead of the protocol thread, worth it on "
+                             "several cores with sha256 or blake2b64 checksums or jumbo packets (default: 0, "
+                             "verify on the protocol thread)")
+    parser.add_argument('--debug', action='store_true', help="log every packet")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="append a JSON record of every finished transfer to FILE ('-' for stdout)")
+    parser.add_argument('--stats-endpoint', action='store_true',
+                        help="answer 'STAT' datagrams on the transfer port with a JSON snapshot of the statistics "
+                             "(off by default: any source gets a reply much larger than the query)")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        serve(args.server_ip, args.server_port, args.max_sessions, args.recv_window, False, args.debug, args.stats,
+              args.sndbuf, args.rcvbuf, args.ack_every, args.ack_delay / 1000, args.verify_threads,
+              args.stats_endpoint)
+        return
+    workers = [multiprocessing.Process(target=serve, args=(args.server_ip, args.server_port, args.max_sessions,
+                                                           args.recv_window, True, args.debug, args.stats,
+                                                           args.sndbuf, args.rcvbuf, args.ack_every,
+                                                           args.ack_delay / 1000, args.verify_threads,
+                                                           args.stats_endpoint))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()